@@ -5,8 +5,15 @@ import subprocess
 import sqlite3
 import secrets
 import string
+import hmac
+import hashlib
+import re
+import threading
+import time
 from datetime import datetime
 from .forgejo import ForgejoClient
+from .snapshot import SnapshotCache
+from .gitobjects import last_commit_date
 
 bp = Blueprint('agora', __name__)
 
@@ -15,6 +22,59 @@ bp = Blueprint('agora', __name__)
 EDITOR_BASE_URL = os.environ.get('AGORA_EDITOR_URL', 'https://edit.anagora.org')
 FORGE_BASE_URL = os.environ.get('AGORA_FORGE_URL', 'https://git.anagora.org')
 AGORA_BASE_URL = os.environ.get('AGORA_URL', 'https://anagora.org')
+# Shared secret configured on forge webhooks. If unset, /webhook refuses every request unless
+# unsigned hooks are explicitly allowed (e.g. for local development).
+WEBHOOK_SECRET = os.environ.get('AGORA_WEBHOOK_SECRET')
+WEBHOOK_ALLOW_UNSIGNED = os.environ.get('AGORA_WEBHOOK_ALLOW_UNSIGNED', '').lower() in ('1', 'true', 'yes')
+
+def normalize_repo_url(url):
+    """
+    Reduces a repository URL to host/path so that the https and ssh URLs of a repo compare equal,
+    e.g. ssh://git@git.anagora.org:2222/user/garden.git -> git.anagora.org/user/garden.
+    """
+    url = (url or '').strip().lower()
+    url = re.sub(r'^[a-z+]+://', '', url)
+    url = re.sub(r'^[^@/]+@', '', url)
+    # host:port/path and scp-like host:path both become host/path.
+    url = re.sub(r'^([^/:]+):(\d+/)?', r'\1/', url)
+    url = url.rstrip('/')
+    if url.endswith('.git'):
+        url = url[:-len('.git')]
+    return url
+
+def verify_webhook_signature(payload):
+    """Checks the HMAC-SHA256 signature sent by Forgejo/Gitea or GitHub against WEBHOOK_SECRET."""
+    if not WEBHOOK_SECRET:
+        return WEBHOOK_ALLOW_UNSIGNED
+    signature = (request.headers.get('X-Forgejo-Signature')
+                 or request.headers.get('X-Gitea-Signature')
+                 or request.headers.get('X-Hub-Signature-256', '').replace('sha256=', '', 1))
+    if not signature:
+        return False
+    expected = hmac.new(WEBHOOK_SECRET.encode(), payload, hashlib.sha256).hexdigest()
+    return hmac.compare_digest(expected, signature)
+
+def request_sync(target, reason):
+    """Asks the running pull worker to sync a target now, through the sync_requests table in bridge.db."""
+    db_path = os.path.expanduser('~/agora/bridge.db')
+    conn = sqlite3.connect(db_path, timeout=10)
+    try:
+        with conn:
+            # Same definition as in pull.py, whichever runs first creates it.
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS sync_requests (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    target TEXT NOT NULL,
+                    requested TEXT,
+                    reason TEXT
+                )
+            ''')
+            conn.execute(
+                "INSERT INTO sync_requests (target, requested, reason) VALUES (?, ?, ?)",
+                (target, datetime.now().isoformat(), reason)
+            )
+    finally:
+        conn.close()
 
 def get_source_last_updated(source):
     """
@@ -32,6 +92,12 @@ def get_source_last_updated(source):
             if not os.path.isdir(os.path.join(target_path, '.git')):
                 return f"Not a git repository"
 
+            # Reading the commit directly avoids a git process per source; fall back to git for
+            # anything the reader doesn't handle.
+            date = last_commit_date(target_path)
+            if date:
+                return date
+
             result = subprocess.run(
                 ['git', '-C', target_path, 'log', '-1', '--format=%cd', '--date=iso'],
                 capture_output=True, text=True, check=True,
@@ -49,26 +115,57 @@ def get_source_last_updated(source):
         except OSError as e:
             return f"File error: {e}"
 
-def get_db_info():
-    """Gets high-level information from the agora.db sqlite file."""
+# Read-only connections to agora.db, kept per thread (snapshot refreshers, request threads).
+db_connections = threading.local()
+
+def get_agora_db(db_path):
+    """Returns this thread's read-only connection to db_path, reopening it if the file was replaced."""
+    inode = os.stat(db_path).st_ino
+    connections = db_connections.__dict__.setdefault('connections', {})
+    cached = connections.get(db_path)
+    if cached and cached[0] == inode:
+        return cached[1]
+    if cached:
+        cached[1].close()
+    conn = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)
+    connections[db_path] = (inode, conn)
+    return conn
+
+def get_db_info(exact=False):
+    """
+    Gets high-level information from the agora.db sqlite file.
+    Row counts are estimates from sqlite_stat1 (refreshed by the cache builder on deploy) or,
+    for tables without statistics, the largest rowid; exact=True counts every row instead.
+    """
     db_path = os.path.expanduser('~/agora/agora.db')
     if not os.path.exists(db_path):
         return None
 
-    db_info = {'path': db_path, 'stats': []}
+    db_info = {'path': db_path, 'stats': [], 'exact': exact}
     try:
-        conn = sqlite3.connect(db_path)
+        conn = get_agora_db(db_path)
         cursor = conn.cursor()
         cursor.execute("SELECT name FROM sqlite_master WHERE type='table';")
-        tables = cursor.fetchall()
+        tables = [row[0] for row in cursor.fetchall()]
+
+        estimates = {}
+        if not exact and 'sqlite_stat1' in tables:
+            for table_name, stat in cursor.execute("SELECT tbl, stat FROM sqlite_stat1"):
+                estimates[table_name] = int(stat.split()[0])
 
         for table_name in tables:
-            table_name = table_name[0]
-            cursor.execute(f"SELECT COUNT(*) FROM {table_name}")
-            count = cursor.fetchone()[0]
+            count = estimates.get(table_name)
+            if count is None and not exact:
+                try:
+                    cursor.execute(f"SELECT MAX(rowid) FROM {table_name}")
+                    count = cursor.fetchone()[0] or 0
+                except sqlite3.OperationalError:
+                    pass # WITHOUT ROWID table
+            if count is None:
+                cursor.execute(f"SELECT COUNT(*) FROM {table_name}")
+                count = cursor.fetchone()[0]
             db_info['stats'].append({'table': table_name, 'rows': count})
-        
-        conn.close()
+
         return db_info
     except sqlite3.Error as e:
         db_info['error'] = f"Database error: {e}"
@@ -95,13 +192,66 @@ def get_bridge_status():
     
     return status_map
 
+SERVICE_PROPERTIES = ['Id', 'LoadState', 'ActiveState', 'SubState', 'ActiveEnterTimestamp',
+                      'ActiveEnterTimestampMonotonic', 'NRestarts', 'MemoryCurrent']
+
+def parse_service_properties(props):
+    """Turns the output of `systemctl show` for a unit into the service dicts of get_services_status."""
+    def number(key):
+        value = props.get(key, '')
+        # Unset numbers show up as '[not set]' or as UINT64_MAX.
+        return int(value) if value.isdigit() and int(value) < 2**64 - 1 else None
+
+    state = props.get('ActiveState') or 'unknown'
+    if props.get('LoadState') == 'not-found':
+        state = 'not-found'
+    uptime = None
+    entered = number('ActiveEnterTimestampMonotonic')
+    if state == 'active' and entered:
+        # systemd and time.monotonic() both use CLOCK_MONOTONIC.
+        uptime = max(int(time.monotonic() - entered / 1e6), 0)
+    return {
+        'state': state,
+        'sub_state': props.get('SubState'),
+        'since': props.get('ActiveEnterTimestamp') or None,
+        'uptime': uptime,
+        'restarts': number('NRestarts'),
+        'memory': number('MemoryCurrent'),
+    }
+
+# The states get_services_status last saw, so that it only logs changes.
+last_service_states = {}
+
+def log_service_changes(status_map, error=None):
+    """
+    Logs the services' states when the list of services or any state changed since the last
+    check (as an error if the check itself failed), and at debug level otherwise: this runs
+    every few seconds in every API process.
+    """
+    global last_service_states
+    states = {svc: info['state'] for svc, info in status_map.items()}
+    if states == last_service_states:
+        current_app.logger.debug(f"Service status unchanged: {states}")
+        return
+    changes = [f"{svc}: {last_service_states.get(svc, 'new')} -> {state}"
+               for svc, state in states.items() if last_service_states.get(svc) != state]
+    changes += [f"{svc}: no longer monitored" for svc in last_service_states.keys() - states.keys()]
+    last_service_states = states
+    if error:
+        current_app.logger.error(f"{error}; {', '.join(changes)}")
+    else:
+        current_app.logger.info(f"Service status changed: {', '.join(changes)}")
+
 def get_services_status():
-    """Checks the status of Agora-related systemd services."""
+    """
+    Checks the status of Agora-related systemd services. Returns a dict per service with its
+    ActiveState (or 'not-found'), SubState, uptime in seconds, restart count and memory in bytes.
+    """
     # Try to find the conf directory relative to this file
     base_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
     conf_dir = os.path.join(base_dir, 'conf')
     
-    current_app.logger.info(f"Looking for services in: {conf_dir}")
+    current_app.logger.debug(f"Looking for services in: {conf_dir}")
     
     services = []
     if os.path.isdir(conf_dir):
@@ -109,11 +259,11 @@ def get_services_status():
             for f in os.listdir(conf_dir):
                 if f.endswith('.service'):
                     services.append(f.replace('.service', ''))
-            current_app.logger.info(f"Found services in conf dir: {services}")
+            current_app.logger.debug(f"Found services in conf dir: {services}")
         except Exception as e:
             current_app.logger.error(f"Error listing conf dir: {e}")
     else:
-        current_app.logger.warning(f"Conf dir not found at: {conf_dir}")
+        current_app.logger.debug(f"Conf dir not found at: {conf_dir}")
     
     # Absolute fallback if no services found or conf dir missing
     if not services:
@@ -126,35 +276,37 @@ def get_services_status():
             'agora-bluesky-bot',
             'agora-matrix-bot',
         ]
-        current_app.logger.info(f"Using fallback service list: {services}")
+        current_app.logger.debug(f"Using fallback service list: {services}")
 
-    status_map = {}
-    for svc in sorted(list(set(services))):
-        try:
-            # Check --user services. We don't use check=True to avoid exception on non-zero exit.
-            # systemctl is-active returns non-zero if not active, which is fine.
-            result = subprocess.run(
-                ['systemctl', '--user', 'is-active', svc],
-                capture_output=True, text=True, timeout=5
-            )
-            status = result.stdout.strip()
-            # If stdout is empty, it might be an error or unknown service
-            final_status = status if status else "unknown"
-            status_map[svc] = final_status
-            current_app.logger.info(f"Service {svc} status: {final_status}")
-        except subprocess.TimeoutExpired:
-            status_map[svc] = "timeout"
-            current_app.logger.error(f"Service {svc} timed out checking status")
-        except Exception as e:
-            status_map[svc] = f"error"
-            current_app.logger.error(f"Service {svc} check failed: {e}")
-    
+    units = sorted(set(services))
+    # Every path returns the full dict shape (see parse_service_properties); the template relies on it.
+    status_map = {svc: parse_service_properties({'ActiveState': 'unknown'}) for svc in units}
+    try:
+        # One call for every unit; `systemctl show` prints a block of properties per unit, in order.
+        result = subprocess.run(
+            ['systemctl', '--user', 'show', '-p', ','.join(SERVICE_PROPERTIES)] + [f"{svc}.service" for svc in units],
+            capture_output=True, text=True, timeout=5
+        )
+    except subprocess.TimeoutExpired:
+        status_map = {svc: parse_service_properties({'ActiveState': 'timeout'}) for svc in units}
+        log_service_changes(status_map, error="Timed out checking service status")
+        return status_map
+    except Exception as e:
+        status_map = {svc: parse_service_properties({'ActiveState': 'error'}) for svc in units}
+        log_service_changes(status_map, error=f"Service status check failed: {e}")
+        return status_map
+
+    for block in result.stdout.strip().split('\n\n'):
+        props = dict(line.split('=', 1) for line in block.splitlines() if '=' in line)
+        svc = props.get('Id', '').removesuffix('.service')
+        if svc in status_map:
+            status_map[svc] = parse_service_properties(props)
+    log_service_changes(status_map)
     return status_map
 
 
-@bp.route('/')
-def index():
-    """Displays the main status page and a list of available API endpoints."""
+def get_sources():
+    """Reads sources.yaml and annotates each source with its last update on disk. Returns (sources, error_message)."""
     sources = []
     error_message = None
     config_path = os.path.expanduser('~/agora/sources.yaml')
@@ -178,11 +330,36 @@ def index():
     except yaml.YAMLError as e:
         error_message = f"Error parsing YAML file at {config_path}: {e}"
 
-    db_info = get_db_info()
-    service_status = get_services_status()
-    bridge_status = get_bridge_status()
+    return sources, error_message
+
+# The status page only renders snapshots of these, refreshed in the background every TTL seconds:
+# with ~1000 gardens, computing them on each request took tens of seconds.
+status = SnapshotCache()
+status.register('sources', get_sources, ttl=300)
+status.register('db_info', get_db_info, ttl=300)
+status.register('services', get_services_status, ttl=5)
+status.register('bridge_status', get_bridge_status, ttl=10)
 
-    # Enrich sources with bridge status
+@bp.route('/')
+def index():
+    """
+    Displays the main status page and a list of available API endpoints.
+
+    Parameters:
+    Query:
+    - exact (bool, optional): Count the rows of every agora.db table instead of showing estimates. Slow on large databases.
+    """
+    status.start(current_app._get_current_object())
+    (sources, error_message), sources_time = status.get('sources', ([], None))
+    if request.args.get('exact', '').lower() in ('1', 'true', 'yes'):
+        db_info = get_db_info(exact=True)
+    else:
+        db_info, _ = status.get('db_info')
+    service_status, _ = status.get('services', {})
+    bridge_status, _ = status.get('bridge_status', {})
+
+    # Enrich (copies of) the snapshot's sources with bridge status
+    sources = [dict(source) for source in sources]
     for source in sources:
         target = source.get('target')
         if target in bridge_status:
@@ -238,9 +415,99 @@ def index():
         db_info=db_info,
         error_message=error_message,
         endpoints=endpoints,
-        service_status=service_status
+        service_status=service_status,
+        loading=sources_time is None,
+        updated=datetime.fromtimestamp(sources_time).strftime('%Y-%m-%d %H:%M:%S') if sources_time else None
     )
 
+@bp.route('/status/services', methods=['GET'])
+def services_status():
+    """
+    Returns the state, uptime (seconds), restart count and memory (bytes) of each Agora systemd service as JSON.
+    Served from a snapshot refreshed every few seconds, so dashboards can poll it.
+    """
+    status.start(current_app._get_current_object())
+    services, updated = status.get('services', {})
+    return jsonify({'services': services, 'updated': updated})
+
+SOURCE_SORT_KEYS = ('target', 'last_success', 'last_attempt')
+
+@bp.route('/status/sources', methods=['GET'])
+def sources_status():
+    """
+    Returns configured sources with their sync status from bridge.db as JSON, one page at a time.
+    Supports ETag/If-None-Match: polling clients get an empty 304 while nothing changed.
+
+    Parameters:
+    Query:
+    - status (string, optional): Comma-separated sync statuses to include, case-insensitive: 'OK', 'ERROR' (last sync failed) or 'unknown' (never synced).
+    - format (string, optional): Only sources with this format (e.g. 'git').
+    - prefix (string, optional): Only sources whose target starts with this (e.g. 'garden/').
+    - sort (string, optional): 'target' (default), 'last_success' or 'last_attempt'; prefix with '-' for descending. Never-synced sources sort last.
+    - page (int, optional): Page number, starting at 1. Defaults to 1.
+    - per_page (int, optional): Sources per page, up to 1000. Defaults to 100.
+    """
+    try:
+        page = int(request.args.get('page', 1))
+        per_page = int(request.args.get('per_page', 100))
+    except ValueError:
+        return jsonify({'error': 'page and per_page must be integers.'}), 400
+    if page < 1 or not 1 <= per_page <= 1000:
+        return jsonify({'error': 'page must be at least 1 and per_page between 1 and 1000.'}), 400
+    sort = request.args.get('sort', 'target')
+    descending = sort.startswith('-')
+    sort = sort.lstrip('-')
+    if sort not in SOURCE_SORT_KEYS:
+        return jsonify({'error': f"sort must be one of {', '.join(SOURCE_SORT_KEYS)}."}), 400
+
+    status.start(current_app._get_current_object())
+    (sources, _), _ = status.get('sources', ([], None))
+    bridge_status, _ = status.get('bridge_status', {})
+
+    statuses = {value.strip().lower() for value in request.args.get('status', '').split(',') if value.strip()}
+    source_format = request.args.get('format')
+    prefix = request.args.get('prefix', '')
+    results = []
+    for source in sources:
+        target = source.get('target', '')
+        bridge = bridge_status.get(target, {})
+        entry = {
+            'target': target,
+            'url': source.get('url'),
+            'format': source.get('format'),
+            'last_updated': source.get('last_updated'),
+            'status': bridge.get('status') or 'unknown',
+            'last_attempt': bridge.get('last_attempt'),
+            'last_success': bridge.get('last_success'),
+            'last_error': bridge.get('last_error'),
+        }
+        if statuses and entry['status'].lower() not in statuses:
+            continue
+        if source_format and entry['format'] != source_format:
+            continue
+        if not target.startswith(prefix):
+            continue
+        results.append(entry)
+
+    # Sort in two passes so that sources without a value stay at the end either way.
+    present = [entry for entry in results if entry[sort]]
+    missing = [entry for entry in results if not entry[sort]]
+    present.sort(key=lambda entry: entry[sort], reverse=descending)
+    missing.sort(key=lambda entry: entry['target'])
+    results = present + missing
+
+    start = (page - 1) * per_page
+    response = jsonify({
+        'sources': results[start:start + per_page],
+        'total': len(results),
+        'page': page,
+        'per_page': per_page,
+    })
+    # The ETag is a hash of the body, so it only changes when the page does.
+    response.add_etag()
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
+
 @bp.route('/sources', methods=['POST'])
 def add_source():
     """
@@ -334,10 +601,14 @@ def add_source():
                 message = "Source added to config, but directory already exists (skipped clone)."
         except subprocess.CalledProcessError as e:
             # Warning: config was updated but clone failed.
+            status.invalidate('sources')
             return jsonify({'message': 'Source added to config, but git clone failed.', 'error': e.stderr, 'source': new_source}), 202
         except Exception as e:
+             status.invalidate('sources')
              return jsonify({'message': 'Source added to config, but an error occurred during cloning.', 'error': str(e), 'source': new_source}), 202
 
+    # After the clone, so the refresh sees the new garden on disk.
+    status.invalidate('sources')
     return jsonify({'message': message, 'source': new_source}), 201
 
 @bp.route('/provision', methods=['POST'])
@@ -444,7 +715,9 @@ def provision_garden():
     except Exception as e:
         current_app.logger.error(f"Provisioning succeeded but failed to add to local Agora: {e}")
         # We still return success because the user account IS created.
-        
+    # After the clone, so the refresh sees the new garden on disk.
+    status.invalidate('sources')
+
     return jsonify({
         'message': 'Garden provisioned successfully.',
         'username': username,
@@ -453,4 +726,57 @@ def provision_garden():
         'editor_url': f"{EDITOR_BASE_URL}/@{username}",
         'forge_url': f"{FORGE_BASE_URL}/user/login",
         'agora_url': f"{AGORA_BASE_URL}/@{username}"
-    }), 201
\ No newline at end of file
+    }), 201
+
+@bp.route('/webhook', methods=['POST'])
+def webhook():
+    """
+    Receives push webhooks from Forgejo/Gitea or GitHub and asks the pull worker to sync the garden right away.
+
+    Parameters:
+    Headers:
+    - X-Forgejo-Event / X-Gitea-Event / X-GitHub-Event (string, required): The event type; only 'push' triggers a sync.
+    - X-Forgejo-Signature / X-Gitea-Signature / X-Hub-Signature-256 (string, required): HMAC-SHA256 of the body with AGORA_WEBHOOK_SECRET.
+    JSON Payload:
+    - repository (object, required): The pushed repository; its clone_url, ssh_url or html_url must match a source URL.
+    """
+    if not WEBHOOK_SECRET and not WEBHOOK_ALLOW_UNSIGNED:
+        return jsonify({'error': 'Webhooks are not configured on Bridge (AGORA_WEBHOOK_SECRET is unset).'}), 503
+    if not verify_webhook_signature(request.get_data()):
+        return jsonify({'error': 'Invalid signature.'}), 403
+
+    event = (request.headers.get('X-Forgejo-Event')
+             or request.headers.get('X-Gitea-Event')
+             or request.headers.get('X-GitHub-Event'))
+    if event == 'ping':
+        return jsonify({'message': 'pong'}), 200
+    if event != 'push':
+        return jsonify({'message': f"Ignoring event {event}."}), 202
+
+    payload = request.get_json(silent=True) or {}
+    repository = payload.get('repository') or {}
+    urls = {normalize_repo_url(repository.get(key)) for key in ('clone_url', 'ssh_url', 'html_url', 'git_url')}
+    urls.discard('')
+    if not urls:
+        return jsonify({'error': 'Payload has no repository URL.'}), 400
+
+    config_path = os.path.expanduser('~/agora/sources.yaml')
+    try:
+        with open(config_path, 'r') as f:
+            sources = yaml.safe_load(f) or []
+    except (FileNotFoundError, yaml.YAMLError) as e:
+        return jsonify({'error': f"Could not read sources: {e}"}), 500
+
+    targets = [s['target'] for s in sources if s.get('target') and normalize_repo_url(s.get('url')) in urls]
+    if not targets:
+        return jsonify({'error': f"No source matches repository {repository.get('full_name')}."}), 404
+
+    try:
+        for target in targets:
+            request_sync(target, f"{event} webhook")
+    except sqlite3.Error as e:
+        current_app.logger.error(f"Failed to queue sync request: {e}")
+        return jsonify({'error': f"Could not queue sync: {e}"}), 500
+
+    current_app.logger.info(f"Webhook: queued sync for {', '.join(targets)}.")
+    return jsonify({'message': 'Sync queued.', 'targets': targets}), 202
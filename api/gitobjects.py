@@ -0,0 +1,207 @@
+"""
+Reads the committer date of HEAD straight from a repository's files, which is much cheaper than
+running `git log -1` for each of thousands of gardens. Handles loose and packed refs, loose
+objects and version 2 pack indexes (including deltified objects); anything else (alternates,
+reftable, unusual layouts) makes last_commit_date return None so callers can fall back to git.
+"""
+import glob
+import mmap
+import os
+import struct
+import zlib
+from datetime import datetime, timedelta, timezone
+
+OBJ_OFS_DELTA = 6
+OBJ_REF_DELTA = 7
+TYPE_NAMES = {1: b'commit', 2: b'tree', 3: b'blob', 4: b'tag'}
+
+
+def resolve_ref(git_dir, ref):
+    """Returns the hex sha a ref points to, following symbolic refs, or None."""
+    for _ in range(10):
+        path = os.path.join(git_dir, ref)
+        if os.path.isfile(path):
+            with open(path) as f:
+                value = f.read().strip()
+        else:
+            value = packed_ref(git_dir, ref)
+            if value is None:
+                return None
+        if not value.startswith('ref:'):
+            return value
+        ref = value[len('ref:'):].strip()
+    return None
+
+
+def packed_ref(git_dir, ref):
+    try:
+        with open(os.path.join(git_dir, 'packed-refs')) as f:
+            for line in f:
+                if line.startswith(('#', '^')):
+                    continue
+                sha, _, name = line.strip().partition(' ')
+                if name == ref:
+                    return sha
+    except FileNotFoundError:
+        pass
+    return None
+
+
+def read_object(git_dir, sha):
+    """Returns (type name, data) for an object, or None if it isn't a loose or packed object here."""
+    loose = os.path.join(git_dir, 'objects', sha[:2], sha[2:])
+    if os.path.isfile(loose):
+        with open(loose, 'rb') as f:
+            raw = zlib.decompress(f.read())
+        header, _, data = raw.partition(b'\0')
+        return header.split(b' ')[0], data
+
+    binsha = bytes.fromhex(sha)
+    for idx_path in glob.glob(os.path.join(git_dir, 'objects', 'pack', 'pack-*.idx')):
+        offset = find_in_index(idx_path, binsha)
+        if offset is not None:
+            with open(idx_path[:-len('.idx')] + '.pack', 'rb') as f, \
+                    mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as pack:
+                obj_type, data = read_packed(git_dir, pack, offset)
+            return TYPE_NAMES[obj_type], data
+    return None
+
+
+def find_in_index(idx_path, binsha):
+    """Looks a binary sha up in a version 2 pack index; returns its offset in the pack or None."""
+    with open(idx_path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as idx:
+        if idx[:8] != b'\377tOc\0\0\0\2':
+            raise ValueError(f"{idx_path}: not a version 2 pack index")
+        fanout = 8
+        count = struct.unpack_from('>I', idx, fanout + 255 * 4)[0]
+        first = binsha[0]
+        lo = struct.unpack_from('>I', idx, fanout + (first - 1) * 4)[0] if first else 0
+        hi = struct.unpack_from('>I', idx, fanout + first * 4)[0]
+        shas = fanout + 256 * 4
+        while lo < hi:
+            mid = (lo + hi) // 2
+            candidate = idx[shas + mid * 20:shas + mid * 20 + 20]
+            if candidate < binsha:
+                lo = mid + 1
+            elif candidate > binsha:
+                hi = mid
+            else:
+                offsets = shas + count * 20 + count * 4
+                offset = struct.unpack_from('>I', idx, offsets + mid * 4)[0]
+                if offset & 0x80000000:
+                    large = offsets + count * 4
+                    offset = struct.unpack_from('>Q', idx, large + (offset & 0x7fffffff) * 8)[0]
+                return offset
+    return None
+
+
+def read_packed(git_dir, pack, offset):
+    """Returns (type, data) of the object at offset in a pack, resolving deltas."""
+    byte = pack[offset]
+    obj_type = (byte >> 4) & 7
+    size = byte & 15
+    shift = 4
+    pos = offset + 1
+    while byte & 0x80:
+        byte = pack[pos]
+        size |= (byte & 0x7f) << shift
+        shift += 7
+        pos += 1
+
+    if obj_type == OBJ_OFS_DELTA:
+        byte = pack[pos]
+        pos += 1
+        distance = byte & 0x7f
+        while byte & 0x80:
+            byte = pack[pos]
+            pos += 1
+            distance = ((distance + 1) << 7) | (byte & 0x7f)
+        base_type, base = read_packed(git_dir, pack, offset - distance)
+        return base_type, apply_delta(base, inflate(pack, pos))
+    if obj_type == OBJ_REF_DELTA:
+        base_sha = pack[pos:pos + 20].hex()
+        base_type, base = read_object(git_dir, base_sha)
+        base_type = next(t for t, name in TYPE_NAMES.items() if name == base_type)
+        return base_type, apply_delta(base, inflate(pack, pos + 20))
+    return obj_type, inflate(pack, pos)
+
+
+def inflate(pack, pos):
+    decompressor = zlib.decompressobj()
+    data = bytearray()
+    # Objects are zlib streams of unknown compressed length; feed chunks until the stream ends.
+    while not decompressor.eof:
+        chunk = pack[pos:pos + 65536]
+        if not chunk:
+            break
+        data += decompressor.decompress(chunk)
+        pos += len(chunk)
+    return bytes(data)
+
+
+def apply_delta(base, delta):
+    def varint(pos):
+        value = shift = 0
+        while True:
+            byte = delta[pos]
+            pos += 1
+            value |= (byte & 0x7f) << shift
+            shift += 7
+            if not byte & 0x80:
+                return value, pos
+
+    _, pos = varint(0)  # Size of the base.
+    _, pos = varint(pos)  # Size of the result.
+    result = bytearray()
+    while pos < len(delta):
+        op = delta[pos]
+        pos += 1
+        if op & 0x80:
+            # Copy a range of the base.
+            start = length = 0
+            for i in range(4):
+                if op & (1 << i):
+                    start |= delta[pos] << (8 * i)
+                    pos += 1
+            for i in range(3):
+                if op & (1 << (4 + i)):
+                    length |= delta[pos] << (8 * i)
+                    pos += 1
+            result += base[start:start + (length or 0x10000)]
+        else:
+            # Insert the next op bytes.
+            result += delta[pos:pos + op]
+            pos += op
+    return bytes(result)
+
+
+def format_git_date(timestamp, tz):
+    """Formats a timestamp and +HHMM offset like `git log --date=iso`: 2024-01-31 18:02:03 +0100."""
+    sign = -1 if tz.startswith('-') else 1
+    offset = timedelta(hours=int(tz[1:3]), minutes=int(tz[3:5])) * sign
+    date = datetime.fromtimestamp(int(timestamp), timezone(offset))
+    return f"{date.strftime('%Y-%m-%d %H:%M:%S')} {tz}"
+
+
+def last_commit_date(repo_path):
+    """
+    Returns the committer date of HEAD in the repository at repo_path formatted like
+    `git log -1 --format=%cd --date=iso`, or None if it can't be read without git.
+    """
+    try:
+        git_dir = os.path.join(repo_path, '.git')
+        sha = resolve_ref(git_dir, 'HEAD')
+        if not sha:
+            return None
+        obj = read_object(git_dir, sha)
+        if obj is None or obj[0] != b'commit':
+            return None
+        for line in obj[1].split(b'\n'):
+            if not line:
+                break  # End of the headers.
+            if line.startswith(b'committer '):
+                timestamp, tz = line.rsplit(b' ', 2)[-2:]
+                return format_git_date(timestamp.decode(), tz.decode())
+    except (OSError, ValueError, KeyError, IndexError, StopIteration, TypeError, zlib.error):
+        return None
+    return None
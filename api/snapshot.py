@@ -0,0 +1,54 @@
+import threading
+import time
+
+
+class SnapshotCache:
+    """
+    Keeps the latest result of slow functions (subprocesses, big queries), recomputed in
+    background threads once older than their TTL, so requests only ever read a snapshot.
+    """
+
+    def __init__(self):
+        self.entries = {}
+        self.values = {}
+        self.events = {}
+        self.lock = threading.Lock()
+        self.started = False
+
+    def register(self, name, func, ttl):
+        """Adds func, to be called (in an app context) every ttl seconds; its result is served as name."""
+        self.entries[name] = (func, ttl)
+        self.events[name] = threading.Event()
+
+    def start(self, app):
+        """Starts one refresher thread per entry, once per process."""
+        with self.lock:
+            if self.started:
+                return
+            self.started = True
+        for name in self.entries:
+            thread = threading.Thread(target=self._refresh, args=(app, name), name=f"snapshot-{name}", daemon=True)
+            thread.start()
+
+    def get(self, name, default=None):
+        """Returns (value, unix time it was computed), or (default, None) if it hasn't been yet."""
+        with self.lock:
+            return self.values.get(name, (default, None))
+
+    def invalidate(self, name):
+        """Recomputes name now instead of waiting for its TTL, e.g. after sources.yaml changed."""
+        self.events[name].set()
+
+    def _refresh(self, app, name):
+        func, ttl = self.entries[name]
+        event = self.events[name]
+        while True:
+            event.clear()
+            try:
+                with app.app_context():
+                    value = func()
+                with self.lock:
+                    self.values[name] = (value, time.time())
+            except Exception as e:
+                app.logger.error(f"Failed to refresh {name}: {e}")
+            event.wait(ttl)
@@ -16,26 +16,60 @@
 # an [[agora bridge]], that is, a utility that takes a .yaml file describing a set of [[personal knowledge graphs]] or [[digital gardens]] and pulls them to be consumed by other bridges or an [[agora server]]. [[flancian]]
 
 import argparse
+import asyncio
 import glob
+import heapq
+import itertools
 import logging
 import os
+import random
+import re
+import shutil
+import signal
 import time
 import yaml
 import sqlite3
-from multiprocessing import Pool, JoinableQueue, Process
 import subprocess
-this_path = os.getcwd()
+from contextlib import asynccontextmanager
+from urllib.parse import urlparse
+
+try:
+    import httpx
+except ImportError:
+    # Without httpx, prechecks fall back to git ls-remote for every remote.
+    httpx = None
+# Helper scripts (import_stoa.py, fedwiki.sh) live next to this file; never rely on the process cwd.
+this_path = os.path.dirname(os.path.abspath(__file__))
 
 # for git commands, in seconds.
 TIMEOUT="60"
+# Seconds a timed out command gets to exit after SIGTERM before it is killed.
+KILL_GRACE = 10
 
 class StatusTracker:
-    def __init__(self, db_path):
+    """
+    Records sync status in bridge.db through one long-lived connection.
+
+    Writes are buffered and flushed in a single transaction every flush_interval seconds
+    (see run_forever) or as soon as batch_size of them are pending, so thousands of syncs
+    per hour cost a handful of commits instead of one connection and fsync each.
+    The database is in WAL mode so the API can keep reading while we write.
+    """
+    def __init__(self, db_path, batch_size=100):
         self.db_path = db_path
+        self.batch_size = batch_size
+        # Pending (sql, params) writes, applied in order on flush.
+        self.pending = []
+        self.conn = sqlite3.connect(db_path, timeout=30)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        # WAL is still durable at the end of each checkpoint; losing the last flush on a crash is fine.
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute('PRAGMA busy_timeout=30000')
         self._setup_db()
 
     def _setup_db(self):
-        with sqlite3.connect(self.db_path) as conn:
+        with self.conn as conn:
             conn.execute('''
                 CREATE TABLE IF NOT EXISTS garden_status (
                     target TEXT PRIMARY KEY,
@@ -46,48 +80,263 @@ class StatusTracker:
                     status TEXT
                 )
             ''')
+            # Scheduling state, so that adapted intervals and backoff survive restarts.
+            # next_due is a unix timestamp; interval is in seconds.
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS garden_schedule (
+                    target TEXT PRIMARY KEY,
+                    interval REAL,
+                    next_due REAL,
+                    failures INTEGER DEFAULT 0,
+                    last_change TEXT,
+                    remote_ref TEXT
+                )
+            ''')
+            # Databases created before remote_ref was tracked need the column added.
+            columns = [row[1] for row in conn.execute("PRAGMA table_info(garden_schedule)")]
+            if 'remote_ref' not in columns:
+                conn.execute("ALTER TABLE garden_schedule ADD COLUMN remote_ref TEXT")
+            # One row per task run; started is a unix timestamp and durations are in seconds.
+            # Phases that didn't happen (e.g. merge after a failed fetch) are NULL.
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS sync_runs (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    target TEXT NOT NULL,
+                    task TEXT NOT NULL,
+                    started REAL NOT NULL,
+                    duration REAL,
+                    clone_seconds REAL,
+                    fetch_seconds REAL,
+                    merge_seconds REAL,
+                    bytes_received INTEGER,
+                    commits_pulled INTEGER,
+                    exit_code INTEGER,
+                    success INTEGER
+                )
+            ''')
+            conn.execute("CREATE INDEX IF NOT EXISTS sync_runs_target_started ON sync_runs (target, started)")
+            conn.execute("CREATE INDEX IF NOT EXISTS sync_runs_started ON sync_runs (started)")
+            # Manifest of the files each successful pull or clone touched, for incremental indexing
+            # downstream (see sqlite-import/worker.py). One row per path; rows of one pull share
+            # old_head/new_head (old_head is NULL for clones). Consumers keep the last id they saw.
+            # status is A(dded), M(odified), D(eleted) or T(ype change) as in git diff --name-status.
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS garden_changes (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    target TEXT NOT NULL,
+                    created REAL NOT NULL,
+                    old_head TEXT,
+                    new_head TEXT,
+                    status TEXT NOT NULL,
+                    path TEXT NOT NULL
+                )
+            ''')
+            conn.execute("CREATE INDEX IF NOT EXISTS garden_changes_created ON garden_changes (created)")
+            # Requests for an immediate sync of a target, e.g. from the API's webhook endpoint.
+            # The API may create this table first; keep both definitions in sync.
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS sync_requests (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    target TEXT NOT NULL,
+                    requested TEXT,
+                    reason TEXT
+                )
+            ''')
+            # Runs older than the retention window are rolled up into per day totals.
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS sync_runs_daily (
+                    day TEXT NOT NULL,
+                    target TEXT NOT NULL,
+                    runs INTEGER,
+                    failures INTEGER,
+                    duration REAL,
+                    bytes_received INTEGER,
+                    commits_pulled INTEGER,
+                    PRIMARY KEY (day, target)
+                )
+            ''')
 
-    def update(self, target, url=None, success=True, error=None):
+    def _write(self, sql, params):
+        self.pending.append((sql, params))
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self.pending:
+            return
+        pending, self.pending = self.pending, []
+        try:
+            with self.conn:
+                for sql, params in pending:
+                    self.conn.execute(sql, params)
+        except Exception as e:
+            # E.g. the database is locked by another writer: keep the batch for the next flush.
+            L.error(f"TRACKER: FAILED to flush {len(pending)} updates, will retry: {e}")
+            self.pending = pending + self.pending
+
+    def close(self):
+        self.flush()
+        self.conn.close()
+
+    def last_successes(self):
+        """Returns the time of the last successful sync per target (None if never)."""
+        self.flush()
+        return {row['target']: row['last_success'] for row in self.conn.execute("SELECT target, last_success FROM garden_status")}
+
+    def take_requests(self):
+        """Returns (and consumes) the targets other processes asked us to sync right away."""
+        # No flush: sync_requests is only written by other processes.
+        try:
+            with self.conn:
+                rows = self.conn.execute("SELECT id, target, reason FROM sync_requests ORDER BY id").fetchall()
+                if rows:
+                    self.conn.execute("DELETE FROM sync_requests WHERE id <= ?", (rows[-1]['id'],))
+            return [(row['target'], row['reason']) for row in rows]
+        except Exception as e:
+            L.error(f"TRACKER: FAILED to read sync requests: {e}")
+            return []
+
+    def get_status(self, target):
+        self.flush()
+        return self.conn.execute("SELECT * FROM garden_status WHERE target=?", (target,)).fetchone()
+
+    def load_schedule(self):
+        schedule = {}
+        try:
+            self.flush()
+            for row in self.conn.execute("SELECT * FROM garden_schedule"):
+                schedule[row['target']] = dict(row)
+        except Exception as e:
+            L.error(f"TRACKER: FAILED to load schedule: {e}")
+        return schedule
+
+    def save_schedule(self, target, interval, next_due, failures, changed):
         now = time.strftime('%Y-%m-%d %H:%M:%S')
+        self._write('''
+            INSERT INTO garden_schedule (target, interval, next_due, failures, last_change)
+            VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT(target) DO UPDATE SET
+                interval=excluded.interval,
+                next_due=excluded.next_due,
+                failures=excluded.failures,
+                last_change=COALESCE(excluded.last_change, garden_schedule.last_change)
+        ''', (target, interval, next_due, failures, now if changed else None))
+
+    def record_run(self, target, task, started, duration, success, stats):
+        self._write('''
+            INSERT INTO sync_runs (target, task, started, duration, clone_seconds, fetch_seconds, merge_seconds,
+                                   bytes_received, commits_pulled, exit_code, success)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ''', (target, task, started, duration, stats.get('clone_seconds'), stats.get('fetch_seconds'),
+              stats.get('merge_seconds'), stats.get('bytes_received'), stats.get('commits_pulled'),
+              stats.get('exit_code'), int(success)))
+
+    def record_changes(self, target, old_head, new_head, changes):
+        """Appends the (status, path) pairs changed between two commits to garden_changes."""
+        now = time.time()
+        # Written in one transaction, so readers never see half of a pull.
+        self.flush()
         try:
-            with sqlite3.connect(self.db_path) as conn:
-                if success:
-                    conn.execute('''
-                        INSERT INTO garden_status (target, url, last_attempt, last_success, last_error, status)
-                        VALUES (?, ?, ?, ?, ?, ?)
-                        ON CONFLICT(target) DO UPDATE SET
-                            last_attempt=excluded.last_attempt,
-                            last_success=excluded.last_attempt,
-                            last_error=NULL,
-                            status='OK'
-                    ''', (target, url, now, now, None, 'OK'))
-                else:
-                    conn.execute('''
-                        INSERT INTO garden_status (target, url, last_attempt, last_error, status)
-                        VALUES (?, ?, ?, ?, ?)
-                        ON CONFLICT(target) DO UPDATE SET
-                            last_attempt=excluded.last_attempt,
-                            last_error=excluded.last_error,
-                            status='ERROR'
-                    ''', (target, url, now, error, 'ERROR'))
+            with self.conn:
+                self.conn.executemany('''
+                    INSERT INTO garden_changes (target, created, old_head, new_head, status, path)
+                    VALUES (?, ?, ?, ?, ?, ?)
+                ''', [(target, now, old_head, new_head, status, path) for status, path in changes])
         except Exception as e:
-            L.error(f"TRACKER: FAILED to update {target}: {e}")
+            L.error(f"TRACKER: FAILED to record changes for {target}: {e}")
+
+    def prune_runs(self, days):
+        """Rolls sync_runs older than days up into sync_runs_daily and deletes them, with old change manifests."""
+        cutoff = time.time() - days * 86400
+        self.flush()
+        try:
+            with self.conn:
+                self.conn.execute('''
+                    INSERT INTO sync_runs_daily (day, target, runs, failures, duration, bytes_received, commits_pulled)
+                    SELECT date(started, 'unixepoch'), target, COUNT(*), SUM(success = 0), SUM(duration),
+                           SUM(bytes_received), SUM(commits_pulled)
+                    FROM sync_runs WHERE started < ? GROUP BY 1, 2
+                    ON CONFLICT(day, target) DO UPDATE SET
+                        runs=runs + excluded.runs,
+                        failures=failures + excluded.failures,
+                        duration=COALESCE(duration, 0) + COALESCE(excluded.duration, 0),
+                        bytes_received=COALESCE(bytes_received, 0) + COALESCE(excluded.bytes_received, 0),
+                        commits_pulled=COALESCE(commits_pulled, 0) + COALESCE(excluded.commits_pulled, 0)
+                ''', (cutoff,))
+                deleted = self.conn.execute("DELETE FROM sync_runs WHERE started < ?", (cutoff,)).rowcount
+                self.conn.execute("DELETE FROM garden_changes WHERE created < ?", (cutoff,))
+            if deleted:
+                L.info(f"TRACKER: rolled up {deleted} sync runs older than {days} days.")
+        except Exception as e:
+            L.error(f"TRACKER: FAILED to prune sync runs: {e}")
+
+    def save_remote_ref(self, target, ref):
+        self._write('''
+            INSERT INTO garden_schedule (target, remote_ref) VALUES (?, ?)
+            ON CONFLICT(target) DO UPDATE SET remote_ref=excluded.remote_ref
+        ''', (target, ref))
+
+    def update(self, target, url=None, success=True, error=None):
+        now = time.strftime('%Y-%m-%d %H:%M:%S')
+        if success:
+            self._write('''
+                INSERT INTO garden_status (target, url, last_attempt, last_success, last_error, status)
+                VALUES (?, ?, ?, ?, ?, ?)
+                ON CONFLICT(target) DO UPDATE SET
+                    last_attempt=excluded.last_attempt,
+                    last_success=excluded.last_attempt,
+                    last_error=NULL,
+                    status='OK'
+            ''', (target, url, now, now, None, 'OK'))
+        else:
+            self._write('''
+                INSERT INTO garden_status (target, url, last_attempt, last_error, status)
+                VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT(target) DO UPDATE SET
+                    last_attempt=excluded.last_attempt,
+                    last_error=excluded.last_error,
+                    status='ERROR'
+            ''', (target, url, now, error, 'ERROR'))
 
 def dir_path(string):
     if not os.path.isdir(string):
         print(f"Trying to create {string}.")
-        output = subprocess.run(['mkdir', '-p', string], capture_output=True)
-        if output.stderr:
-            L.error(output.stderr)
+        try:
+            os.makedirs(string, exist_ok=True)
+        except OSError as e:
+            print(f"Couldn't create {string}: {e}")
     return os.path.abspath(string)
 
 parser = argparse.ArgumentParser(description='Agora Bridge')
-parser.add_argument('--config', dest='config', type=argparse.FileType('r'), required=True, help='The path to a YAML file describing the digital gardens to consume.')
+parser.add_argument('--config', dest='config', required=True, help='The path to a YAML file describing the digital gardens to consume. Changes are picked up while running.')
 parser.add_argument('--output-dir', dest='output_dir', type=dir_path, required=True, help='The path to a directory where the digital gardens will be stored (one subdirectory per user).')
 parser.add_argument('--verbose', dest='verbose', type=bool, default=False, help='Whether to log more information.')
 parser.add_argument('--reset', dest='reset', type=bool, default=False, help='Whether to git reset --hard whenever a pull fails.')
 parser.add_argument('--reset_only', dest='reset_only', type=bool, default=False, help='Whether do reset --hard instead of pulling.')
 parser.add_argument('--delay', dest='delay', type=float, default=0.1, help='Delay between pulls.')
+parser.add_argument('--min-interval', dest='min_interval', type=float, default=60, help='Shortest time between pulls of a source that changes often, in seconds.')
+parser.add_argument('--max-interval', dest='max_interval', type=float, default=6*3600, help='Longest time between pulls of a source that never changes, in seconds.')
+parser.add_argument('--precheck', dest='precheck', type=bool, default=False, help='Whether to run git ls-remote first and only pull gardens whose remote HEAD moved.')
+parser.add_argument('--max-backoff', dest='max_backoff', type=float, default=24*3600, help='Longest time to wait before retrying a failing source, in seconds.')
+parser.add_argument('--clone-depth', dest='clone_depth', type=int, default=0, help='Default history depth for new clones (git clone --depth); 0 clones the full history. Sources can override this with "depth".')
+parser.add_argument('--clone-filter', dest='clone_filter', default=None, help='Default partial clone filter for new clones, e.g. blob:none or blob:limit=1m. Sources can override this with "filter".')
+parser.add_argument('--unshallow', dest='unshallow', type=bool, default=False, help='Whether to fetch the full history of shallow clones before pulling. Sources can opt in with "unshallow: true".')
+parser.add_argument('--unshallow-timeout', dest='unshallow_timeout', type=float, default=3600, help='How long fetching the full history of a shallow clone may take, in seconds. It can be much larger than the clone, but must not hold a sync slot forever.')
+parser.add_argument('--flush-interval', dest='flush_interval', type=float, default=2, help='How often buffered status updates are written to bridge.db, in seconds.')
+parser.add_argument('--history-days', dest='history_days', type=float, default=30, help='How long to keep individual runs in the sync_runs table of bridge.db before rolling them up into daily totals.')
+parser.add_argument('--metrics-port', dest='metrics_port', type=int, default=0, help='Port to serve Prometheus metrics on at /metrics; 0 disables the endpoint.')
+parser.add_argument('--metrics-host', dest='metrics_host', default='127.0.0.1', help='Address to bind the metrics endpoint to.')
+parser.add_argument('--metrics-file', dest='metrics_file', default=None, help='Path to periodically write Prometheus metrics to, e.g. for the API to serve.')
+parser.add_argument('--reload-interval', dest='reload_interval', type=float, default=10, help='How often to check the config file for changes, in seconds.')
+parser.add_argument('--startup-window', dest='startup_window', type=float, default=300, help='Spread sources that are already due at startup over this many seconds, stalest first; 0 starts them all at once.')
+parser.add_argument('--host-rate', dest='host_rate', type=float, default=5, help='Maximum number of sync tasks started per second against any one host; 0 disables rate limiting.')
+parser.add_argument('--host-burst', dest='host_burst', type=int, default=10, help='Number of sync tasks that can start at once against a host before --host-rate applies.')
+parser.add_argument('--ssh-control-dir', dest='ssh_control_dir', default=os.path.expanduser('~/.ssh/agora-bridge'), help='Directory for the SSH ControlMaster sockets shared by git over SSH.')
+parser.add_argument('--ssh-control-persist', dest='ssh_control_persist', type=float, default=600, help='How long idle SSH master connections stay open, in seconds; 0 disables connection sharing.')
+parser.add_argument('--poll-interval', dest='poll_interval', type=float, default=2, help='How often to check bridge.db for sync requests (e.g. from webhooks), in seconds.')
+parser.add_argument('--concurrency', dest='concurrency', type=int, default=64, help='Maximum number of sync tasks (git operations or imports) in flight at once.')
+parser.add_argument('--host-limit', dest='host_limits', action='append', default=[], metavar='HOST=N', help='Maximum number of sync tasks in flight against HOST. Can be repeated.')
+parser.add_argument('--default-host-limit', dest='default_host_limit', type=int, default=8, help='Maximum number of sync tasks in flight against any host without its own --host-limit.')
 args = parser.parse_args()
 
 logging.basicConfig()
@@ -97,32 +346,552 @@ if args.verbose:
 else:
     L.setLevel(logging.INFO)
 
-Q = JoinableQueue()
-WORKERS = 6
+# Per-host limits for the forges most gardens live on; --host-limit overrides these.
+HOST_LIMITS = {
+    'github.com': 16,
+    'gitlab.com': 8,
+    'git.anagora.org': 4,
+}
+
+class Scheduler:
+    """
+    Keeps periodic tasks in a priority queue keyed by the time they are next due.
+
+    Each source's interval adapts to how often it actually changes: it halves when a
+    pull brings in new commits and grows by half when it doesn't, within
+    [min_interval, max_interval]. Failing sources back off exponentially up to
+    max_backoff. State is persisted in bridge.db so it survives restarts.
+    """
+    def __init__(self, tracker, min_interval, max_interval, max_backoff):
+        self.tracker = tracker
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.max_backoff = max_backoff
+        self.state = tracker.load_schedule()
+        self.tasks = {}
+        self.heap = []
+        # Tie breaker so that tasks themselves are never compared.
+        self.counter = itertools.count()
+        # target -> sequence number of its live heap entry.
+        self.queued = {}
+        # Sources with a run in flight (or waiting for their clone).
+        self.busy = set()
+        # Busy sources to run again as soon as they're done.
+        self.triggered = set()
+
+    def add(self, task, hold=False):
+        """
+        Adds or replaces the periodic task for a source. A held task isn't scheduled
+        until release() is called, e.g. once the garden has been cloned.
+        """
+        target = task[1]
+        new = target not in self.tasks
+        self.tasks[target] = task
+        state = self.state.setdefault(target, {'interval': self.min_interval, 'next_due': None, 'failures': 0})
+        if hold:
+            self.busy.add(target)
+        elif new:
+            self._push(target, state['next_due'] or time.time())
+
+    def release(self, target):
+        self.busy.discard(target)
+        self.triggered.discard(target)
+        if target in self.tasks:
+            self._push(target, self.state[target]['next_due'] or time.time())
+
+    def trigger(self, target):
+        """Runs a source as soon as possible, or again right after its current run."""
+        if target not in self.tasks:
+            return False
+        if target in self.busy:
+            self.triggered.add(target)
+        else:
+            self._push(target, time.time())
+        return True
+
+    def spread(self, targets, window):
+        """
+        Spreads the sources in targets that are already due over the next window seconds,
+        in the order given and with some jitter, so a restart doesn't hit every remote at once.
+        """
+        now = time.time()
+        overdue = [t for t in targets if t in self.tasks and (self.state[t]['next_due'] or 0) <= now]
+        if not overdue or window <= 0:
+            return
+        step = window / len(overdue)
+        for i, target in enumerate(overdue):
+            self.state[target]['next_due'] = now + i * step + random.uniform(0, step)
+            # Held sources pick this up when released.
+            if target in self.queued:
+                self._push(target, self.state[target]['next_due'])
+        L.info(f"Spreading {len(overdue)} overdue sources over the next {window:.0f}s.")
+
+    def remove(self, target):
+        """Stops scheduling a source; a run already in flight is left to finish."""
+        self.tasks.pop(target, None)
+        self.queued.pop(target, None)
+
+    def _push(self, target, due):
+        # Only the latest entry for a target is live, older ones are skipped when popped.
+        seq = next(self.counter)
+        self.queued[target] = seq
+        heapq.heappush(self.heap, (due, seq, target))
+
+    def _live(self, entry):
+        _, seq, target = entry
+        return self.queued.get(target) == seq and target not in self.busy
+
+    def pop_due(self):
+        now = time.time()
+        due = []
+        while self.heap and self.heap[0][0] <= now:
+            entry = heapq.heappop(self.heap)
+            if not self._live(entry):
+                continue
+            target = entry[2]
+            del self.queued[target]
+            # Busy until reschedule(), so a source never has two runs in flight.
+            self.busy.add(target)
+            due.append(self.tasks[target])
+        return due
+
+    def seconds_until_next(self):
+        while self.heap and not self._live(self.heap[0]):
+            heapq.heappop(self.heap)
+        if not self.heap:
+            return None
+        return max(0, self.heap[0][0] - time.time())
+
+    def reschedule(self, target, success, changed):
+        self.busy.discard(target)
+        if target not in self.tasks:
+            # Removed from sources.yaml while it was running.
+            return
+        state = self.state[target]
+        interval = state['interval'] or self.min_interval
+        if success:
+            state['failures'] = 0
+            if changed:
+                interval = max(self.min_interval, interval / 2)
+            elif changed is not None:
+                interval = min(self.max_interval, interval * 1.5)
+            delay = interval
+        else:
+            state['failures'] = (state['failures'] or 0) + 1
+            delay = min(self.max_backoff, interval * 2 ** state['failures'])
+        state['interval'] = interval
+        state['next_due'] = time.time() + delay
+        self.tracker.save_schedule(target, interval, state['next_due'], state['failures'], success and changed)
+        if target in self.triggered:
+            # Something changed upstream while we were running, don't wait for the next slot.
+            self.triggered.discard(target)
+            self._push(target, time.time())
+            return
+        self._push(target, state['next_due'])
+        L.debug(f"{target}: next run in {delay:.0f}s (interval {interval:.0f}s, failures {state['failures']}).")
+
+class Metrics:
+    """
+    Counters, histograms and gauges for the sync loop, rendered in the Prometheus text format.
+    Gauges are callables sampled at render time.
+    """
+    # Histogram buckets for task durations, in seconds.
+    BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, float('inf'))
+
+    def __init__(self):
+        self.counters = {}
+        self.histograms = {}
+        self.gauges = {}
+
+    def inc(self, name, labels, value=1):
+        key = (name, tuple(sorted(labels.items())))
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, labels, value):
+        key = (name, tuple(sorted(labels.items())))
+        if key not in self.histograms:
+            self.histograms[key] = {'buckets': [0] * len(self.BUCKETS), 'sum': 0, 'count': 0}
+        histogram = self.histograms[key]
+        for i, bound in enumerate(self.BUCKETS):
+            if value <= bound:
+                histogram['buckets'][i] += 1
+        histogram['sum'] += value
+        histogram['count'] += 1
+
+    def gauge(self, name, func):
+        self.gauges[name] = func
+
+    @staticmethod
+    def _labels(labels):
+        if not labels:
+            return ''
+        return '{' + ','.join(f'{k}="{v}"' for k, v in labels) + '}'
+
+    def render(self):
+        lines = []
+        for name in sorted({name for name, _ in self.counters}):
+            lines.append(f'# TYPE {name} counter')
+            for (n, labels), value in sorted(self.counters.items()):
+                if n == name:
+                    lines.append(f'{name}{self._labels(labels)} {value}')
+        for name in sorted({name for name, _ in self.histograms}):
+            lines.append(f'# TYPE {name} histogram')
+            for (n, labels), histogram in sorted(self.histograms.items()):
+                if n != name:
+                    continue
+                for bound, count in zip(self.BUCKETS, histogram['buckets']):
+                    le = '+Inf' if bound == float('inf') else str(bound)
+                    lines.append(f'{name}_bucket{self._labels(labels + (("le", le),))} {count}')
+                lines.append(f'{name}_sum{self._labels(labels)} {histogram["sum"]}')
+                lines.append(f'{name}_count{self._labels(labels)} {histogram["count"]}')
+        for name, func in sorted(self.gauges.items()):
+            lines.append(f'# TYPE {name} gauge')
+            lines.append(f'{name} {func()}')
+        return '\n'.join(lines) + '\n'
+
+    async def handle(self, reader, writer):
+        """Serves GET /metrics over a bare bones HTTP/1.0 exchange."""
+        try:
+            request = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), timeout=5)
+            path = request.split(b' ')[1] if request.count(b' ') >= 2 else b''
+            if path.split(b'?')[0] == b'/metrics':
+                status, body = '200 OK', self.render().encode('utf-8')
+            else:
+                status, body = '404 Not Found', b'Not found. Try /metrics.\n'
+            writer.write(
+                f'HTTP/1.0 {status}\r\nContent-Type: text/plain; version=0.0.4\r\n'
+                f'Content-Length: {len(body)}\r\nConnection: close\r\n\r\n'.encode('utf-8') + body)
+            await writer.drain()
+        except Exception as e:
+            L.debug(f"Metrics request failed: {e}")
+        finally:
+            writer.close()
+
+    def write(self, path):
+        """Writes the current metrics to path atomically, for consumers that prefer a file."""
+        try:
+            with open(path + '.tmp', 'w') as f:
+                f.write(self.render())
+            os.replace(path + '.tmp', path)
+        except OSError as e:
+            L.error(f"Couldn't write metrics to {path}: {e}")
+
+async def run(cmd, cwd=None, env=None, timeout=TIMEOUT, check=False):
+    """
+    Runs cmd without blocking the event loop and returns a subprocess.CompletedProcess.
+    Like timeout(1), commands running for longer than timeout seconds are sent SIGTERM
+    (then SIGKILL after KILL_GRACE seconds) and reported with exit code 124; timeout=None
+    waits indefinitely.
+    """
+    # A session of its own lets us kill git together with any helpers it spawned.
+    proc = await asyncio.create_subprocess_exec(
+        *cmd, cwd=cwd, env=env, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE, start_new_session=True)
+    try:
+        stdout, stderr = await asyncio.wait_for(proc.communicate(), timeout=float(timeout) if timeout is not None else None)
+        returncode = proc.returncode
+    except asyncio.TimeoutError:
+        # SIGTERM first, so git can clean up after itself (remove a half-done clone, release its locks).
+        communicate = asyncio.ensure_future(proc.communicate())
+        try:
+            os.killpg(proc.pid, signal.SIGTERM)
+            await asyncio.wait_for(asyncio.shield(communicate), timeout=KILL_GRACE)
+        except ProcessLookupError:
+            pass
+        except asyncio.TimeoutError:
+            try:
+                os.killpg(proc.pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+        stdout, stderr = await communicate
+        returncode = 124
+    if check and returncode != 0:
+        raise subprocess.CalledProcessError(returncode, cmd, stdout, stderr)
+    return subprocess.CompletedProcess(cmd, returncode, stdout, stderr)
+
+def url_host(url):
+    """Returns the host a git url points to; scp-like urls (git@host:path) are supported."""
+    host = urlparse(url).hostname
+    if host:
+        return host
+    if ':' in url and not url.startswith('/'):
+        return url.split(':', 1)[0].split('@')[-1]
+    return 'local'
+
+class TokenBucket:
+    """Allows rate operations per second on average, with bursts of up to burst operations."""
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    async def take(self):
+        while True:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+class Limiter:
+    """
+    Bounds the number of sync tasks in flight, globally and per remote host, and
+    optionally the rate at which tasks against each host start.
+    """
+    def __init__(self, concurrency, host_limits, default_host_limit, host_rate=0, host_burst=1):
+        self.concurrency = concurrency
+        self.total = asyncio.Semaphore(concurrency)
+        self.host_limits = host_limits
+        self.default_host_limit = default_host_limit
+        self.hosts = {}
+        self.host_rate = host_rate
+        self.host_burst = host_burst
+        self.buckets = {}
+        # Tasks waiting for a slot and tasks holding one, for metrics.
+        self.waiting = 0
+        self.active = 0
+
+    @asynccontextmanager
+    async def slot(self, url):
+        host = url_host(url)
+        if host not in self.hosts:
+            self.hosts[host] = asyncio.Semaphore(self.host_limits.get(host, self.default_host_limit))
+            if self.host_rate > 0:
+                self.buckets[host] = TokenBucket(self.host_rate, self.host_burst)
+        # Take the host slot first so tasks queued for a busy host don't hold global slots.
+        self.waiting += 1
+        acquired = False
+        try:
+            async with self.hosts[host]:
+                if host in self.buckets:
+                    await self.buckets[host].take()
+                async with self.total:
+                    self.waiting -= 1
+                    acquired = True
+                    self.active += 1
+                    try:
+                        yield
+                    finally:
+                        self.active -= 1
+        finally:
+            if not acquired:
+                self.waiting -= 1
+
+def git_env():
+    """
+    Returns the environment for git subprocesses: never prompt, and share one SSH
+    connection per host across git invocations (and sync cycles) through ControlMaster.
+    """
+    env = os.environ.copy()
+    env['GIT_TERMINAL_PROMPT'] = '0'
+    # Respect an explicit GIT_SSH_COMMAND, e.g. one that selects a deploy key.
+    if args.ssh_control_persist > 0 and 'GIT_SSH_COMMAND' not in env:
+        env['GIT_SSH_COMMAND'] = (
+            f'ssh -o ControlMaster=auto -o ControlPath={args.ssh_control_dir}/%C '
+            f'-o ControlPersist={args.ssh_control_persist:.0f}')
+    return env
+
+class RefAdvertisements:
+    """
+    Reads the remote HEAD of http(s) remotes from the smart HTTP ref advertisement
+    (what git ls-remote fetches), reusing keep-alive connections to each host across
+    sync cycles instead of paying a TLS handshake and a git process per garden.
+    """
+    def __init__(self, keepalive):
+        self.client = httpx.AsyncClient(
+            timeout=float(TIMEOUT),
+            follow_redirects=True,
+            limits=httpx.Limits(max_keepalive_connections=args.concurrency, keepalive_expiry=keepalive),
+            # Some forges only serve the smart protocol to git clients.
+            headers={'User-Agent': 'git/2.0 (agora-bridge)'},
+        )
+
+    async def head(self, url):
+        """Returns the commit HEAD points to, or None if the remote didn't give us one."""
+        response = await self.client.get(url.rstrip('/') + '/info/refs', params={'service': 'git-upload-pack'})
+        if response.status_code != 200:
+            return None
+        if not response.headers.get('content-type', '').startswith('application/x-git-upload-pack-advertisement'):
+            # A dumb HTTP server or a login page.
+            return None
+        return parse_advertised_head(response.content)
+
+def parse_advertised_head(data):
+    """Returns the HEAD commit in a protocol v0 upload-pack ref advertisement, or None."""
+    pos = 0
+    while pos + 4 <= len(data):
+        length = int(data[pos:pos + 4], 16)
+        if length == 0:
+            # flush-pkt, separates the service header from the refs.
+            pos += 4
+            continue
+        line = data[pos + 4:pos + length]
+        pos += length
+        if line.startswith(b'#'):
+            continue
+        # The first ref carries the capabilities after a NUL byte.
+        ref = line.split(b'\0')[0].strip()
+        sha, _, name = ref.partition(b' ')
+        if name == b'HEAD':
+            return sha.decode('ascii')
+    return None
+
+async def git_head(path):
+    """Returns the commit HEAD points to in the repository at path, or None."""
+    output = await run(['git', '-C', path, 'rev-parse', 'HEAD'])
+    if output.returncode != 0:
+        return None
+    return output.stdout.strip().decode('utf-8')
+
+async def git_ls_remote(url, refs=None):
+    """
+    Returns the commit the remote HEAD points to, or None if it can't be determined.
+    http(s) remotes are asked over refs' pooled connections when available.
+    """
+    if refs and urlparse(url).scheme in ('http', 'https'):
+        try:
+            head = await refs.head(url)
+            if head:
+                return head
+        except Exception as e:
+            L.debug(f"Smart HTTP ref advertisement failed for {url}, falling back to ls-remote: {e}")
+    env = git_env()
+    try:
+        output = await run(['git', 'ls-remote', url, 'HEAD'], env=env)
+    except Exception as e:
+        L.error(f"Exception in ls-remote for {url}: {e}")
+        return None
+    if output.returncode != 0 or not output.stdout:
+        return None
+    return output.stdout.split()[0].decode('utf-8')
+
+def clone_flags(options):
+    """Returns the git clone flags for a source, falling back to the global defaults."""
+    flags = []
+    # A per source 'depth: 0' or 'filter: null' opts out of the global default.
+    depth = options.get('depth', args.clone_depth)
+    if depth:
+        flags += ['--depth', str(depth)]
+    clone_filter = options.get('filter', args.clone_filter)
+    if clone_filter:
+        flags += [f'--filter={clone_filter}']
+    return flags
 
-def git_clone(tracker, target, url, path):
+async def git_set_remote(path, url):
+    """Points origin at url, e.g. after the source's url changed in the config."""
+    output = await run(['git', '-C', path, 'remote', 'set-url', 'origin', url])
+    if output.returncode != 0:
+        L.error(f"{path}: couldn't set origin to {url}: {output.stderr.decode('utf-8', errors='replace')}")
+        return False
+    L.info(f"{path}: origin is now {url}")
+    return True
+
+async def git_unshallow(path):
+    """Fetches the missing history of a shallow clone; returns whether it did anything."""
+    if not os.path.exists(os.path.join(path, '.git', 'shallow')):
+        return False
+    L.info(f"Fetching full history for shallow clone in {path}")
+    env = git_env()
+    # The full history can be much larger than the initial clone, hence its own, longer timeout.
+    output = await run(['git', '-C', path, 'fetch', '--unshallow'], env=env, timeout=args.unshallow_timeout)
+    if output.returncode != 0:
+        L.error(f"{path}: couldn't unshallow: {output.stderr.decode('utf-8', errors='replace')}")
+        return False
+    return True
+
+# Sizes as printed by git --progress.
+UNITS = {'bytes': 1, 'KiB': 1024, 'MiB': 1024**2, 'GiB': 1024**3}
+TRANSFER = re.compile(r'(?:Receiving|Unpacking) objects:.*?([\d.]+) (bytes|KiB|MiB|GiB)')
+PROGRESS = re.compile(r'^(remote: )?(Enumerating|Counting|Compressing|Receiving|Resolving|Unpacking|Total|Updating files)')
+
+def split_progress(stderr):
+    """
+    Separates git --progress output from the rest of stderr.
+    Returns (bytes received or None if git didn't say, remaining stderr as text).
+    git only reports sizes when it indexes the received pack, so very small fetches
+    (which get unpacked into loose objects) come back as None.
+    """
+    received = None
+    rest = []
+    for line in re.split(r'[\r\n]', stderr.decode('utf-8', errors='replace')):
+        match = TRANSFER.search(line)
+        if match:
+            received = int(float(match.group(1)) * UNITS[match.group(2)])
+        elif line and not PROGRESS.match(line):
+            rest.append(line)
+    return received, '\n'.join(rest)
+
+async def git_count(path, old, new):
+    output = await run(['git', '-C', path, 'rev-list', '--count', f'{old}..{new}'])
+    if output.returncode != 0:
+        return None
+    return int(output.stdout.strip())
+
+async def git_changes(path, old, new):
+    """
+    Returns the (status, path) pairs that differ between commits old and new, or every
+    tracked file as added if old is None. Renames are reported as a delete and an add.
+    """
+    if old:
+        cmd = ['git', '-C', path, 'diff', '-z', '--name-status', '--no-renames', old, new]
+    else:
+        cmd = ['git', '-C', path, 'ls-tree', '-r', '-z', '--name-only', new]
+    output = await run(cmd)
+    if output.returncode != 0:
+        L.warning(f"{path}: could not list changes {old}..{new}: {output.stderr.decode('utf-8', errors='replace')}")
+        return None
+    fields = output.stdout.decode('utf-8', errors='surrogateescape').split('\0')[:-1]
+    if not old:
+        return [('A', name) for name in fields]
+    return list(zip(fields[0::2], fields[1::2]))
+
+async def record_changes(tracker, target, path, old_head, new_head):
+    if not new_head or new_head == old_head:
+        return
+    changes = await git_changes(path, old_head, new_head)
+    if changes is None:
+        return
+    tracker.record_changes(target, old_head, new_head, changes)
+    L.info(f"{target}: {old_head[:7] if old_head else 'clone'}..{new_head[:7]} touched {len(changes)} files.")
+
+# Task functions take the source's entry in sources.yaml as options and a stats dict
+# they fill in for sync_runs, and return (success, changed); changed is None when we
+# can't tell.
+async def git_clone(tracker, target, url, path, options, stats):
 
     if os.path.exists(path):
         L.info(f"{path} exists, won't clone to it.")
         # Even if it exists, we mark it as a "success" for the clone step
         # as it's ready for the pull step.
         tracker.update(target, url=url, success=True)
-        return
+        return True, False
 
     L.info(f"Running git clone {url} to path {path}")
 
-    env = os.environ.copy()
-    env['GIT_TERMINAL_PROMPT'] = '0'
+    env = git_env()
+    # Report transfer sizes even for fast clones, see split_progress.
+    env['GIT_PROGRESS_DELAY'] = '0'
 
     try:
-        output = subprocess.run(['timeout', TIMEOUT, 'git', 'clone', url, path], capture_output=True, env=env)
+        start = time.monotonic()
+        output = await run(['git', 'clone', '--progress', *clone_flags(options), url, path], env=env)
+        stats['clone_seconds'] = time.monotonic() - start
+        stats['exit_code'] = output.returncode
+        stats['bytes_received'], stderr = split_progress(output.stderr)
         if output.returncode == 0:
             tracker.update(target, url=url, success=True)
-        elif output.returncode == 124:
+            await record_changes(tracker, target, path, None, await git_head(path))
+            return True, True
+        # The path didn't exist before, so whatever a failed clone left there (e.g. just .git, if
+        # it had to be killed) must go; otherwise we'd never try to clone again.
+        remove_failed_clone(path)
+        if output.returncode == 124:
             tracker.update(target, url=url, success=False, error="Timeout cloning repository")
             L.error(f'Timeout while cloning {url}')
         else:
-            error_msg = output.stderr.decode('utf-8', errors='replace') if output.stderr else f"Unknown error (code {output.returncode})"
+            error_msg = stderr if stderr else f"Unknown error (code {output.returncode})"
             if "not found" in error_msg.lower():
                 error_msg = "Repository not found (404)"
             elif "authentication failed" in error_msg.lower():
@@ -133,40 +902,54 @@ def git_clone(tracker, target, url, path):
     except Exception as e:
         tracker.update(target, url=url, success=False, error=str(e))
         L.error(f'Exception while cloning {url}: {e}')
+    return False, None
+
+def remove_failed_clone(path):
+    if os.path.exists(path):
+        L.warning(f"Removing {path} left behind by a failed clone")
+        shutil.rmtree(path, ignore_errors=True)
 
 def clear_stale_lock(path):
-    lock_file = os.path.join(path, '.git', 'index.lock')
-    if os.path.exists(lock_file):
+    """
+    Removes lock files older than 5 minutes, as left by a git process that was killed: index.lock,
+    HEAD.lock and the like directly in .git, and ref locks (e.g. refs/heads/main.lock).
+    """
+    git_dir = os.path.join(path, '.git')
+    lock_files = glob.glob(os.path.join(git_dir, '*.lock')) + glob.glob(os.path.join(git_dir, 'refs', '**', '*.lock'), recursive=True)
+    removed = False
+    for lock_file in lock_files:
         try:
             mtime = os.path.getmtime(lock_file)
             age = time.time() - mtime
             if age > 300: # 5 minutes
                 L.warning(f"Removing stale lock file at {lock_file} (age: {age:.0f}s)")
                 os.remove(lock_file)
-                return True
+                removed = True
         except Exception as e:
             L.error(f"Failed to check/remove lock file {lock_file}: {e}")
-    return False
+    return removed
 
-def git_reset(path):
+async def git_reset(path, stats):
     L.info(f'Trying to git reset --hard')
     clear_stale_lock(path)
-    env = os.environ.copy()
-    env['GIT_TERMINAL_PROMPT'] = '0'
+    env = git_env()
     
     try:
         # 1. Fetch
-        subprocess.run(['timeout', TIMEOUT, 'git', 'fetch', 'origin'], env=env, check=True, capture_output=True)
+        start = time.monotonic()
+        output = await run(['git', '-C', path, 'fetch', '--progress', 'origin'], env=env, check=True)
+        stats['fetch_seconds'] = time.monotonic() - start
+        stats['bytes_received'], _ = split_progress(output.stderr)
         
         # 2. Determine default branch dynamically
         # Try to get it from the remote symref
-        res = subprocess.run(['git', 'symbolic-ref', '--short', 'refs/remotes/origin/HEAD'], capture_output=True, env=env)
+        res = await run(['git', '-C', path, 'symbolic-ref', '--short', 'refs/remotes/origin/HEAD'], env=env)
         if res.returncode == 0:
             branch = res.stdout.strip().decode("utf-8").replace('origin/', '')
         else:
             # Fallback: Ask remote for the HEAD symref
-            res = subprocess.run(['git', 'remote', 'set-head', 'origin', '-a'], capture_output=True, env=env)
-            res = subprocess.run(['git', 'symbolic-ref', '--short', 'refs/remotes/origin/HEAD'], capture_output=True, env=env)
+            res = await run(['git', '-C', path, 'remote', 'set-head', 'origin', '-a'], env=env)
+            res = await run(['git', '-C', path, 'symbolic-ref', '--short', 'refs/remotes/origin/HEAD'], env=env)
             if res.returncode == 0:
                 branch = res.stdout.strip().decode("utf-8").replace('origin/', '')
             else:
@@ -174,7 +957,10 @@ def git_reset(path):
                 branch = "main"
 
         L.info(f"Resetting to origin/{branch}")
-        output = subprocess.run(['timeout', TIMEOUT, 'git', 'reset', '--hard', f'origin/{branch}'], capture_output=True, env=env)
+        start = time.monotonic()
+        output = await run(['git', '-C', path, 'reset', '--hard', f'origin/{branch}'], env=env)
+        stats['merge_seconds'] = time.monotonic() - start
+        stats['exit_code'] = output.returncode
         L.info(f'output: {output.stdout}')
         if output.returncode != 0:
             error_msg = output.stderr.decode('utf-8', errors='replace')
@@ -182,7 +968,8 @@ def git_reset(path):
             return False, error_msg
         return True, None
     except subprocess.CalledProcessError as e:
-        error_msg = e.stderr.decode('utf-8', errors='replace') if e.stderr else str(e)
+        stats['exit_code'] = e.returncode
+        error_msg = split_progress(e.stderr)[1] if e.stderr else str(e)
         if "not found" in error_msg.lower():
             error_msg = "Repository not found (404)"
         elif "authentication failed" in error_msg.lower():
@@ -194,65 +981,77 @@ def git_reset(path):
         return False, str(e)
 
 
-def git_pull(tracker, target, url, path):
+async def git_pull(tracker, target, url, path, options, stats):
 
     if not os.path.exists(path):
-        L.warning(f"{path} doesn't exist, checking if clone error already recorded.")
-        # Check if we already have an error (e.g. from git_clone)
-        with sqlite3.connect(tracker.db_path) as conn:
-            conn.row_factory = sqlite3.Row
-            cursor = conn.cursor()
-            cursor.execute("SELECT status, last_error FROM garden_status WHERE target=?", (target,))
-            row = cursor.fetchone()
-            if row and row['status'] == 'ERROR' and row['last_error']:
-                L.info(f"Preserving existing error for {target}: {row['last_error']}")
-                return
+        # The clone failed (or the source's url was fixed since); failures back off like pulls.
+        L.warning(f"{path} doesn't exist, cloning it first.")
+        return await git_clone(tracker, target, url, path, options, stats)
 
-        tracker.update(target, url=url, success=False, error=f"Path {path} does not exist (clone failed?)")
-        return
+    if options.get('unshallow', args.unshallow):
+        await git_unshallow(path)
 
-    try:
-        os.chdir(path)
-    except FileNotFoundError:
-        L.error(f"Couldn't pull in {path} due to the directory being missing, clone must be run first")
-        tracker.update(target, url=url, success=False, error=f"Path {path} missing during pull")
-        return
+    old_head = await git_head(path)
 
     if args.reset_only:
-        success, error = git_reset(path)
+        success, error = await git_reset(path, stats)
         tracker.update(target, url=url, success=success, error=error)
-        return
+        if not success:
+            return False, None
+        new_head = await git_head(path)
+        if old_head and new_head != old_head:
+            stats['commits_pulled'] = await git_count(path, old_head, new_head)
+        await record_changes(tracker, target, path, old_head, new_head)
+        return True, new_head != old_head
 
     L.info(f"Running git pull in path {path}")
     clear_stale_lock(path)
-    env = os.environ.copy()
-    env['GIT_TERMINAL_PROMPT'] = '0'
+    env = git_env()
+    env['GIT_PROGRESS_DELAY'] = '0'
 
     try:
-        output = subprocess.run(['timeout', TIMEOUT, 'git', 'pull'], capture_output=True, env=env)
+        # This is git pull split in its two phases so we can time them separately.
+        # --ff-only matches what git pull does by default when it isn't configured.
+        start = time.monotonic()
+        output = await run(['git', '-C', path, 'fetch', '--progress'], env=env)
+        stats['fetch_seconds'] = time.monotonic() - start
+        stats['bytes_received'], stderr = split_progress(output.stderr)
+        if output.returncode == 0:
+            start = time.monotonic()
+            output = await run(['git', '-C', path, 'merge', '--ff-only', '@{u}'], env=env)
+            stats['merge_seconds'] = time.monotonic() - start
+            stderr = output.stderr.decode('utf-8', errors='replace')
+        stats['exit_code'] = output.returncode
         if output.returncode == 0:
             tracker.update(target, url=url, success=True)
             L.info(output.stdout.decode('utf-8', errors='replace'))
+            new_head = await git_head(path)
+            if old_head and new_head != old_head:
+                stats['commits_pulled'] = await git_count(path, old_head, new_head)
+            await record_changes(tracker, target, path, old_head, new_head)
+            return True, new_head != old_head
         elif output.returncode == 124:
             tracker.update(target, url=url, success=False, error="Timeout pulling repository")
             L.error(f'{path}: Timeout while pulling')
         else:
-            error_msg = output.stderr.decode('utf-8', errors='replace') if output.stderr else f"Unknown error (code {output.returncode})"
+            error_msg = stderr if stderr else f"Unknown error (code {output.returncode})"
             tracker.update(target, url=url, success=False, error=error_msg)
             L.error(f'{path}: {error_msg}')
             if args.reset:
-                git_reset(path)
+                await git_reset(path, {})
     except Exception as e:
         tracker.update(target, url=url, success=False, error=str(e))
         L.error(f"Pull exception: {e}")
+    return False, None
 
-def stoa_import(tracker, target, url, path):
-    os.chdir(this_path)
+async def stoa_import(tracker, target, url, path, options, stats):
     try:
-        # Run the import_stoa.py script
-        output = subprocess.run(["uv", "run", "python3", f"{this_path}/import_stoa.py", f"--output-dir={path}"], capture_output=True)
+        # Run the import_stoa.py script; uv needs to run from the project to find its environment.
+        output = await run(["uv", "run", "python3", f"{this_path}/import_stoa.py", f"--output-dir={path}"], cwd=this_path, timeout=None)
+        stats['exit_code'] = output.returncode
         if output.returncode == 0:
             tracker.update(target, url=url, success=True)
+            return True, None
         else:
             error_msg = output.stderr.decode('utf-8', errors='replace') if output.stderr else "Unknown error"
             L.error(f"Error in stoa_import: {error_msg}")
@@ -260,76 +1059,242 @@ def stoa_import(tracker, target, url, path):
     except Exception as e:
         L.error(f"Exception in stoa_import: {e}")
         tracker.update(target, url=url, success=False, error=str(e))
+    return False, None
 
-def fedwiki_import(tracker, target, url, path):
-    os.chdir(this_path)
+async def fedwiki_import(tracker, target, url, path, options, stats):
     try:
-        output = subprocess.run([f"{this_path}/fedwiki.sh", url, path], capture_output=True)
+        # fedwiki.sh expects to be run from the project root.
+        output = await run([f"{this_path}/fedwiki.sh", url, path], cwd=this_path, timeout=None)
+        stats['exit_code'] = output.returncode
         if output.returncode == 0:
             tracker.update(target, url=url, success=True)
+            return True, None
         else:
             error_msg = output.stderr.decode('utf-8', errors='replace') if output.stderr else "Unknown error"
             tracker.update(target, url=url, success=False, error=error_msg)
     except Exception as e:
         tracker.update(target, url=url, success=False, error=str(e))
+    return False, None
 
-def worker(db_path):
-    tracker = StatusTracker(db_path)
-    while True:
-        try:
-            task = Q.get(block=True, timeout=60)
-            # task is (func, *args)
-            func = task[0]
-            args_for_func = task[1:]
-            func(tracker, *args_for_func)
-            Q.task_done()
-            # if this is a pull, schedule the same task for another run later.
-            if func in (git_pull, fedwiki_import, stoa_import):
-                Q.put(task)
-            time.sleep(args.delay)
-        except Exception as e:
-            L.error(f"Worker exception: {e}")
-            # Continue the loop
-            continue
+async def sync(tracker, scheduler, limiter, metrics, refs, task, wakeup):
+    """Runs one task within the concurrency limits and reschedules its source."""
+    func, target, url, path, options = task
+    source_format = options.get('format', 'git')
+    try:
+        async with limiter.slot(url):
+            ref = None
+            started = time.time()
+            if args.precheck and func is git_pull and os.path.exists(path):
+                ref = await git_ls_remote(url, refs)
+                if ref and ref == scheduler.state[target].get('remote_ref'):
+                    L.debug(f"{target}: remote HEAD unchanged at {ref}, skipping pull.")
+                    tracker.update(target, url=url, success=True)
+                    tracker.record_run(target, 'precheck', started, time.time() - started, True, {'exit_code': 0})
+                    metrics.inc('agora_bridge_precheck_skips_total', {'format': source_format})
+                    scheduler.reschedule(target, True, False)
+                    return
 
-def main():
+            stats = {}
+            try:
+                success, changed = await func(tracker, target, url, path, options, stats)
+            except Exception as e:
+                L.error(f"Task exception in {func.__name__} for {target}: {e}")
+                success, changed = False, None
+            duration = time.time() - started
+            tracker.record_run(target, func.__name__, started, duration, success, stats)
+            labels = {'task': func.__name__, 'format': source_format}
+            metrics.observe('agora_bridge_task_duration_seconds', labels, duration)
+            result = 'ok' if success else 'timeout' if stats.get('exit_code') == 124 else 'error'
+            metrics.inc('agora_bridge_tasks_total', dict(labels, result=result))
+            if stats.get('bytes_received'):
+                metrics.inc('agora_bridge_received_bytes_total', labels, stats['bytes_received'])
+            await asyncio.sleep(args.delay)
 
+        if func is git_clone:
+            # the pull gets scheduled once the clone is done, and again after every run.
+            scheduler.release(target)
+            return
+        if success and ref:
+            scheduler.state[target]['remote_ref'] = ref
+            tracker.save_remote_ref(target, ref)
+        scheduler.reschedule(target, success, changed)
+    finally:
+        wakeup.set()
+
+async def flush_periodically(tracker, metrics):
+    last_prune = 0
+    while True:
+        await asyncio.sleep(args.flush_interval)
+        tracker.flush()
+        if args.metrics_file:
+            metrics.write(args.metrics_file)
+        if time.time() - last_prune > 3600:
+            tracker.prune_runs(args.history_days)
+            last_prune = time.time()
+
+def load_sources(path):
+    """Returns the sources in the config file at path keyed by target, or None if it can't be read."""
     try:
-        config = yaml.safe_load(args.config)
-    except yaml.YAMLError as e:
-        L.error(e)
+        with open(path) as f:
+            config = yaml.safe_load(f) or []
+        return {item['target']: item for item in config}
+    except (OSError, yaml.YAMLError, KeyError, TypeError) as e:
+        L.error(f"Couldn't load sources from {path}: {e}")
+        return None
 
-    db_path = os.path.join(args.output_dir, 'bridge.db')
-    # Initialize the tracker here to create the DB file before workers start
+async def run_forever(db_path):
+    # Initialize the tracker here to create the DB file before any task runs.
     tracker = StatusTracker(db_path)
+    scheduler = Scheduler(tracker, args.min_interval, args.max_interval, args.max_backoff)
+    host_limits = dict(HOST_LIMITS)
+    for limit in args.host_limits:
+        host, n = limit.split('=', 1)
+        host_limits[host] = int(n)
+    limiter = Limiter(args.concurrency, host_limits, args.default_host_limit, args.host_rate, args.host_burst)
+    refs = None
+    if args.precheck and httpx:
+        refs = RefAdvertisements(keepalive=max(args.ssh_control_persist, 60))
+    if args.ssh_control_persist > 0:
+        os.makedirs(args.ssh_control_dir, mode=0o700, exist_ok=True)
+    metrics = Metrics()
+    metrics.gauge('agora_bridge_queue_length', lambda: limiter.waiting)
+    metrics.gauge('agora_bridge_in_flight', lambda: limiter.active)
+    metrics.gauge('agora_bridge_utilization', lambda: limiter.active / limiter.concurrency)
+    metrics.gauge('agora_bridge_scheduled_sources', lambda: len(scheduler.tasks))
+    metrics.gauge('agora_bridge_pending_writes', lambda: len(tracker.pending))
+    if args.metrics_port:
+        await asyncio.start_server(metrics.handle, args.metrics_host, args.metrics_port)
+        L.info(f"Serving metrics on http://{args.metrics_host}:{args.metrics_port}/metrics")
+    # Set whenever a task finishes, as that might have scheduled something sooner.
+    wakeup = asyncio.Event()
+    running = set()
+
+    def background(coro):
+        t = asyncio.create_task(coro)
+        running.add(t)
+        t.add_done_callback(running.discard)
+
+    def spawn(task):
+        background(sync(tracker, scheduler, limiter, metrics, refs, task, wakeup))
 
-    for item in config:
+    def add_source(item):
         target = item['target']
         url = item['url']
         path = os.path.join(args.output_dir, target)
         if item.get('format') == "fedwiki":
-            Q.put((fedwiki_import, target, url, path))
-            continue
+            scheduler.add((fedwiki_import, target, url, path, item))
+            return
 
         if item.get('format') == "stoa":
-            Q.put((stoa_import, target, url, path))
-            continue
-        
+            scheduler.add((stoa_import, target, url, path, item))
+            return
+
         # Default to git for all other formats (markdown, obsidian, foam, etc.)
-        # schedule one 'clone' run for every garden, in case this is a new garden (or agora).
-        Q.put((git_clone, target, url, path))
-        # pull it once, it will be queued again later from the worker.
-        Q.put((git_pull, target, url, path))
-
-    processes = []
-    for i in range(WORKERS):
-        worker_process = Process(target=worker, args=(db_path,), daemon=True, name='worker_process_{}'.format(i))
-        processes.append(worker_process)
-
-    L.info(f"Starting {WORKERS} workers to execute work items. Status tracked in {db_path}")
-    for process in processes:
-        process.start()
-    Q.join()
+        if not os.path.exists(path) and target not in scheduler.busy:
+            # Clone missing gardens first (new ones, or ones whose url was just fixed); their
+            # pull gets scheduled once the clone is done.
+            scheduler.add((git_pull, target, url, path, item), hold=True)
+            spawn((git_clone, target, url, path, item))
+        else:
+            # Gardens we already have go straight to the schedule (and the startup spread),
+            # without spending a host slot or rate token on a no-op clone.
+            scheduler.add((git_pull, target, url, path, item))
+            if not os.path.exists(path):
+                # A run is in flight; git_pull clones missing gardens, so run again right after it.
+                scheduler.trigger(target)
+
+    sources = {}
+    config_mtime = None
+
+    def reload_sources():
+        """Applies changes to the config file since it was last read, if any."""
+        nonlocal sources, config_mtime
+        try:
+            mtime = os.path.getmtime(args.config)
+        except OSError as e:
+            L.error(f"Couldn't stat {args.config}: {e}")
+            return
+        if mtime == config_mtime:
+            return
+        new_sources = load_sources(args.config)
+        if new_sources is None:
+            # Keep running with what we had, e.g. while the file is being edited.
+            return
+        config_mtime = mtime
+        added = new_sources.keys() - sources.keys()
+        removed = sources.keys() - new_sources.keys()
+        changed = [t for t in new_sources.keys() & sources.keys() if new_sources[t] != sources[t]]
+        for target in removed:
+            scheduler.remove(target)
+        for target in added:
+            add_source(new_sources[target])
+        for target in changed:
+            item = new_sources[target]
+            add_source(item)
+            path = os.path.join(args.output_dir, target)
+            if (item.get('url') != sources[target].get('url') and item.get('format') not in ('fedwiki', 'stoa')
+                    and os.path.isdir(os.path.join(path, '.git'))):
+                background(git_set_remote(path, item['url']))
+        if sources and (added or removed or changed):
+            L.info(f"Reloaded {args.config}: {len(added)} added, {len(removed)} removed, {len(changed)} changed.")
+        sources = new_sources
+
+    reload_sources()
+    last_reload = time.time()
+    last_poll = time.time()
+    # Gardens that have gone the longest without a successful sync (or never had one) go first.
+    last_successes = tracker.last_successes()
+    scheduler.spread(
+        sorted(sources, key=lambda t: (last_successes.get(t) is not None, last_successes.get(t) or '')),
+        args.startup_window)
+
+    # systemd stops us with SIGTERM: unwind like on Ctrl-C, so pending status updates get flushed.
+    asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, asyncio.current_task().cancel)
+
+    L.info(f"Running up to {args.concurrency} sync tasks at once. Status tracked in {db_path}")
+    flusher = asyncio.create_task(flush_periodically(tracker, metrics))
+    try:
+        while True:
+            if time.time() - last_reload >= args.reload_interval:
+                reload_sources()
+                last_reload = time.time()
+
+            if time.time() - last_poll >= args.poll_interval:
+                requests = tracker.take_requests()
+                if requests:
+                    # The request may be for a garden that was just added to the config.
+                    reload_sources()
+                    last_reload = time.time()
+                for target, reason in requests:
+                    if scheduler.trigger(target):
+                        L.info(f"{target}: sync requested ({reason}).")
+                    else:
+                        L.warning(f"{target}: sync requested ({reason}) but it's not in {args.config}.")
+                last_poll = time.time()
+
+            # Everything due is started right away; the limiter decides how much of it actually runs.
+            for task in scheduler.pop_due():
+                spawn(task)
+
+            timeout = scheduler.seconds_until_next()
+            timeout = min(timeout, args.poll_interval) if timeout is not None else args.poll_interval
+            wakeup.clear()
+            try:
+                await asyncio.wait_for(wakeup.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                pass
+    finally:
+        flusher.cancel()
+        tracker.close()
+        if refs:
+            await refs.client.aclose()
+
+def main():
+    db_path = os.path.join(args.output_dir, 'bridge.db')
+    try:
+        asyncio.run(run_forever(db_path))
+    except asyncio.CancelledError:
+        L.info("Stopped.")
 
 if __name__ == "__main__":
     main()
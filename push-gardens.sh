@@ -5,6 +5,12 @@
 # Default to standard garden path if not set
 GARDEN_ROOT="${AGORA_ROOT:-$HOME/agora/garden}"
 
+# Share one SSH connection per host across all pushes (and loop iterations) instead of
+# doing a full SSH handshake per garden. pull.py uses the same control directory.
+SSH_CONTROL_DIR="${AGORA_SSH_CONTROL_DIR:-$HOME/.ssh/agora-bridge}"
+mkdir -p "$SSH_CONTROL_DIR" && chmod 700 "$SSH_CONTROL_DIR"
+export GIT_SSH_COMMAND="${GIT_SSH_COMMAND:-ssh -o ControlMaster=auto -o ControlPath=$SSH_CONTROL_DIR/%C -o ControlPersist=600}"
+
 echo "Starting Garden Pusher loop..."
 echo "Watching: $GARDEN_ROOT"
 
@@ -0,0 +1,222 @@
+# bench.py
+"""
+Benchmarks worker.py against a synthetic Agora, so changes to the cache builder can be
+measured without production data. Like worker.py it needs an agora-server checkout next
+to this repository. For example:
+
+    uv run python sqlite-import/bench.py --users 200 --subnodes 100 --links 10 --jobs 4
+"""
+import argparse
+import glob
+import json
+import os
+import random
+import resource
+import shutil
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+from contextlib import closing, redirect_stdout, nullcontext
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import worker
+
+WORDS = "the agora is a distributed knowledge graph built from digital gardens and other sources".split()
+
+def generate(root, users, nodes, subnodes, size, links, seed):
+    """
+    Writes a garden per user under root/garden, each with subnodes files picked from a shared
+    vocabulary of nodes, about size bytes of text and links wikilinks per file.
+    Returns the list of files written.
+    """
+    rng = random.Random(seed)
+    vocabulary = [f"node {n}" for n in range(nodes)]
+    files = []
+    for u in range(users):
+        garden = os.path.join(root, 'garden', f"user{u}")
+        os.makedirs(garden, exist_ok=True)
+        for node in rng.sample(vocabulary, min(subnodes, nodes)):
+            words = [rng.choice(WORDS) for _ in range(max(size // 6, 1))]
+            for _ in range(links):
+                words.insert(rng.randrange(len(words) + 1), f"[[{rng.choice(vocabulary)}]]")
+            file = os.path.join(garden, node.replace(' ', '-') + '.md')
+            with open(file, 'w') as f:
+                f.write(' '.join(words) + '\n')
+            files.append(file)
+    return files
+
+def touch(files, fraction, seed):
+    """Appends a wikilink to a fraction of files, as if their gardens had been pulled. Returns how many."""
+    rng = random.Random(seed + 1)
+    touched = rng.sample(files, int(len(files) * fraction))
+    for file in touched:
+        with open(file, 'a') as f:
+            f.write("[[benchmark]]\n")
+        # Make sure the mtime moves even on filesystems with coarse timestamps.
+        stat = os.stat(file)
+        os.utime(file, (stat.st_atime, stat.st_mtime + 1))
+    return len(touched)
+
+def rss_mb(pid):
+    """Current resident set size of a process in MiB, from /proc (Linux only)."""
+    with open(f"/proc/{pid}/status") as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1]) / 1024
+    return 0
+
+def child_pids(pid):
+    """All descendants of a process, e.g. the builder's pool processes."""
+    pids = []
+    for children in glob.glob(f"/proc/{pid}/task/*/children"):
+        with open(children) as f:
+            for child in f.read().split():
+                pids.append(int(child))
+                pids.extend(child_pids(int(child)))
+    return pids
+
+class RssSampler(threading.Thread):
+    """
+    Samples the RSS of this process and the total of its children while a phase runs, since
+    ru_maxrss only gives the peak over the whole process lifetime (and of the largest child).
+    """
+
+    def __init__(self, interval=0.05):
+        super().__init__(daemon=True)
+        self.interval = interval
+        self.own = self.children = 0
+        self.done = threading.Event()
+
+    def sample(self):
+        try:
+            own = rss_mb(os.getpid())
+            children = 0
+            for pid in child_pids(os.getpid()):
+                try:
+                    children += rss_mb(pid)
+                except OSError:
+                    pass  # Exited meanwhile.
+        except OSError:
+            return
+        self.own = max(self.own, own)
+        self.children = max(self.children, children)
+
+    def run(self):
+        while not self.done.is_set():
+            self.sample()
+            self.done.wait(self.interval)
+
+    def stop(self):
+        self.done.set()
+        self.join()
+        self.sample()
+
+def lifetime_peak_rss_mb():
+    """Peak RSS over the whole run of this process and of its largest (finished) child, in MiB."""
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    # ru_maxrss is in KiB on Linux and in bytes on macOS.
+    scale = 1024 * 1024 if sys.platform == 'darwin' else 1024
+    return own / scale, children / scale
+
+def phase(results, name, func, *args, **kwargs):
+    # Per phase RSS is sampled from /proc, so it's only reported on Linux.
+    sampler = RssSampler() if os.path.exists('/proc/self/status') else None
+    if sampler:
+        sampler.start()
+    start = time.time()
+    try:
+        value = func(*args, **kwargs)
+    finally:
+        seconds = time.time() - start
+        if sampler:
+            sampler.stop()
+    results['phases'][name] = {
+        'seconds': round(seconds, 3),
+        'peak_rss_mb': round(sampler.own, 1) if sampler else None,
+        'peak_children_rss_mb': round(sampler.children, 1) if sampler else None,
+    }
+    return value
+
+def table_counts(db_path):
+    with closing(sqlite3.connect(db_path)) as db:
+        return {table: db.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0] for table in ('subnodes', 'links')}
+
+parser = argparse.ArgumentParser(description='Benchmarks the cache builder (worker.py) on a synthetic Agora.')
+parser.add_argument('--users', type=int, default=50, help='Gardens to generate.')
+parser.add_argument('--nodes', type=int, default=2000, help='Distinct nodes subnodes are picked from.')
+parser.add_argument('--subnodes', type=int, default=100, help='Subnodes (files) per garden.')
+parser.add_argument('--size', type=int, default=2000, help='Approximate size of each subnode, in bytes.')
+parser.add_argument('--links', type=int, default=5, help='Wikilinks per subnode.')
+parser.add_argument('--touch', type=float, default=0.01, help='Fraction of files to change before the incremental update.')
+parser.add_argument('--jobs', type=int, default=os.cpu_count(), help='Passed to the builder, see worker.py --jobs.')
+parser.add_argument('--links-schema', dest='links_schema', choices=['node', 'subnode'], default='node', help='Passed to the builder, see worker.py --links.')
+parser.add_argument('--seed', type=int, default=0)
+parser.add_argument('--dir', help='Where to generate the Agora and database (default: a temporary directory, removed afterwards).')
+parser.add_argument('--json', action='store_true', help='Print results as JSON, e.g. to compare runs in CI.')
+
+def main():
+    args = parser.parse_args()
+    base = args.dir or tempfile.mkdtemp(prefix='agora-bench-')
+    root = os.path.join(base, 'agora')
+    db_path = os.path.join(base, 'agora.db')
+    for path in (root, db_path):
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        elif os.path.exists(path):
+            os.remove(path)
+
+    app = worker.create_app()
+    app.config['AGORA_PATH'] = root
+    app.config['SQLALCHEMY_DATABASE_URI'] = f"sqlite:///{db_path}"
+
+    results = {'parameters': vars(args), 'phases': {}}
+    # Keep stdout for the JSON; the builder's progress output goes to stderr then.
+    output = redirect_stdout(sys.stderr) if args.json else nullcontext()
+    try:
+        with output:
+            files = phase(results, 'generate', generate, root, args.users, args.nodes, args.subnodes, args.size, args.links, args.seed)
+            results['files'] = len(files)
+            results['bytes'] = sum(os.path.getsize(f) for f in files)
+
+            phase(results, 'build', worker.build_cache, app, jobs=args.jobs, links=args.links_schema)
+            phase(results, 'deploy', worker.deploy_cache, app)
+            results['rows'] = table_counts(db_path)
+            results['db_bytes'] = os.path.getsize(db_path)
+
+            results['touched'] = touch(files, args.touch, args.seed)
+            phase(results, 'incremental', worker.update_cache, app, links=args.links_schema)
+    finally:
+        if not args.dir:
+            shutil.rmtree(base, ignore_errors=True)
+
+    own, child = lifetime_peak_rss_mb()
+    results['lifetime_peak_rss_mb'] = round(own, 1)
+    results['lifetime_peak_child_rss_mb'] = round(child, 1)
+
+    build = results['phases']['build']['seconds']
+    results['files_per_second'] = round(results['files'] / build, 1) if build else None
+    results['mb_per_second'] = round(results['bytes'] / 1024 / 1024 / build, 2) if build else None
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+
+    print()
+    print(f"{results['files']} files, {results['bytes'] / 1024 / 1024:.1f} MiB; "
+          f"{results['rows']['subnodes']} subnodes, {results['rows']['links']} links, "
+          f"database {results['db_bytes'] / 1024 / 1024:.1f} MiB.")
+    print(f"Full build: {results['files_per_second']} files/s, {results['mb_per_second']} MiB/s.")
+    # Peak RSS during each phase: of this process, and of all its children (the pool) together.
+    print(f"{'phase':<12} {'seconds':>10} {'peak RSS':>10} {'children':>10}")
+    for name, stats in results['phases'].items():
+        own = f"{stats['peak_rss_mb']:.1f}MB" if stats['peak_rss_mb'] is not None else '-'
+        children = f"{stats['peak_children_rss_mb']:.1f}MB" if stats['peak_children_rss_mb'] is not None else '-'
+        print(f"{name:<12} {stats['seconds']:>10.3f} {own:>10} {children:>10}")
+    print(f"Lifetime peak RSS: {results['lifetime_peak_rss_mb']:.1f}MB, largest child {results['lifetime_peak_child_rss_mb']:.1f}MB.")
+    print(f"(incremental update after touching {results['touched']} files)")
+
+if __name__ == "__main__":
+    main()
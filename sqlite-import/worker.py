@@ -1,6 +1,10 @@
 # worker.py
+import argparse
+import itertools
 import time
 import sqlite3
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
 from contextlib import closing
 import os
 import sys
@@ -10,7 +14,7 @@ import sys
 agora_server_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '../../agora-server'))
 sys.path.insert(0, agora_server_root)
 
-from app.graph import Graph
+from app.graph import Graph, Subnode
 from app.storage.sqlite_engine import create_tables
 from app import create_app
 
@@ -38,12 +42,315 @@ def get_db_path(app):
 
 
 
-def build_cache(app):
+# Files the Graph turns into subnodes; keep in sync with app/graph.py.
+SUBNODE_SUFFIXES = ('.md', '.org', '.myco', '.txt')
+
+# Rows per executemany() call when loading the _new tables.
+CHUNK_SIZE = 10000
+
+def insert_chunked(db, sql, rows, chunk_size=CHUNK_SIZE):
+    """
+    Runs sql for each row from the iterable rows, chunk_size rows at a time, so rows can be
+    generated lazily instead of materialized in one list. Returns the number of rows.
+    """
+    rows = iter(rows)
+    count = 0
+    while True:
+        chunk = list(itertools.islice(rows, chunk_size))
+        if not chunk:
+            return count
+        db.executemany(sql, chunk)
+        count += len(chunk)
+
+def bulk_load(db):
+    """
+    Tunes a connection for loading the _new tables. WAL lets the server keep reading the live
+    tables meanwhile, and with WAL synchronous=NORMAL can lose the build on power loss but
+    won't corrupt the database; we'd just build again.
+    """
+    db.execute("PRAGMA journal_mode=WAL")
+    db.execute("PRAGMA synchronous=NORMAL")
+    # 256 MiB of page cache, so B-tree pages of the tables being loaded stay in memory.
+    db.execute("PRAGMA cache_size=-262144")
+    db.execute("PRAGMA temp_store=MEMORY")
+
+def create_state_tables(db, suffix=''):
+    """
+    Creates the tables incremental updates need on top of sqlite_engine's schema:
+    subnode_files maps each file on disk to its subnode, and cache_state keeps
+    how far we've read the bridge's change manifest. cache_generations tracks the
+    builds of versioned deploys, see deploy_generation.
+    """
+    db.execute(f"""
+        CREATE TABLE IF NOT EXISTS subnode_files{suffix} (
+            file TEXT PRIMARY KEY,
+            path TEXT NOT NULL,
+            mtime REAL NOT NULL
+        )
+    """)
+    db.execute("""
+        CREATE TABLE IF NOT EXISTS cache_state (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        )
+    """)
+    db.execute("""
+        CREATE TABLE IF NOT EXISTS cache_generations (
+            generation INTEGER PRIMARY KEY,
+            built TEXT,
+            links_schema TEXT,
+            bridge_change_id INTEGER,
+            completed INTEGER DEFAULT 1
+        )
+    """)
+    # Databases from before builds were marked complete; their generations all are.
+    columns = [row[1] for row in db.execute("PRAGMA table_info(cache_generations)")]
+    if 'completed' not in columns:
+        db.execute("ALTER TABLE cache_generations ADD COLUMN completed INTEGER DEFAULT 1")
+
+# The tables a build writes; with versioned deploys these names are views of a generation's tables.
+CACHE_TABLES = ('subnodes', 'links', 'subnode_files')
+
+def is_view(db, name):
+    row = db.execute("SELECT type FROM sqlite_master WHERE name = ?", (name,)).fetchone()
+    return bool(row) and row[0] == 'view'
+
+def ensure_tables(db):
+    """
+    Creates sqlite_engine's tables and ours if needed. create_tables() is skipped once the
+    cache tables are generation views: it would try to index them, which SQLite refuses.
+    """
+    if not is_view(db, 'subnodes'):
+        create_tables(db)
+    create_state_tables(db)
+
+def live_suffix(db):
+    """The suffix of the tables behind subnodes, links and subnode_files: '' or e.g. '_g3'."""
+    if not is_view(db, 'subnodes'):
+        return ''
+    return f"_g{get_state(db, 'generation')}"
+
+def get_state(db, key):
+    row = db.execute("SELECT value FROM cache_state WHERE key = ?", (key,)).fetchone()
+    return row[0] if row else None
+
+def create_new_tables(db, suffix='_new'):
+    """(Re)creates the tables a full build writes to before deploy_cache swaps them in."""
+    print("Creating new temporary tables...")
+    db.execute(f"DROP TABLE IF EXISTS subnodes{suffix}")
+    db.execute(f"DROP TABLE IF EXISTS links{suffix}")
+    db.execute(f"DROP TABLE IF EXISTS subnode_files{suffix}")
+    create_state_tables(db, suffix=suffix)
+
+    # Schema must match sqlite_engine.py
+    db.execute(f"""
+        CREATE TABLE subnodes{suffix} (
+            path TEXT PRIMARY KEY,
+            user TEXT NOT NULL,
+            node TEXT NOT NULL,
+            mtime INTEGER NOT NULL
+        )
+    """)
+    db.execute(f"""
+        CREATE TABLE links{suffix} (
+            source_path TEXT NOT NULL,
+            target_node TEXT NOT NULL,
+            type TEXT NOT NULL,
+            source_node TEXT,
+            PRIMARY KEY (source_path, target_node, type)
+        )
+    """)
+
+def has_index(db, table, column):
+    """Whether table has an index whose first column is column."""
+    for index in db.execute(f"PRAGMA index_list({table})").fetchall():
+        columns = db.execute(f"PRAGMA index_info({index[1]})").fetchall()
+        if columns and columns[0][2] == column:
+            return True
+    return False
+
+def create_cache_indexes(db, suffix, links):
+    """
+    Indexes the cache tables for incremental updates, which look up a node's subnodes and
+    files and rewrite its links: subnodes by node, subnode_files by path and links by source
+    node, plus links by target node (for backlinks) with the subnode links schema. Called after
+    the tables are loaded, which is faster than updating the indexes row by row, and skips
+    indexes that already exist. Index names must be unique in the database and stay with the
+    table when deploy_cache renames it, so each build numbers its own.
+    """
+    wanted = [('subnodes_node', f"subnodes{suffix}", 'node', 'node'),
+              ('subnode_files_path', f"subnode_files{suffix}", 'path', 'path'),
+              ('links_source_node', f"links{suffix}", 'source_node', 'source_node')]
+    if links == 'subnode':
+        wanted.append(('links_target_node', f"links{suffix}", 'target_node', 'target_node, source_node'))
+    wanted = [index for index in wanted if not has_index(db, index[1], index[2])]
+    if not wanted:
+        return
+    names = {name for (name,) in db.execute("SELECT name FROM sqlite_master WHERE type = 'index'")}
+    build = next(n for n in itertools.count(1) if all(f"{prefix}_{n}" not in names for prefix, _, _, _ in wanted))
+    for prefix, table, _, columns in wanted:
+        db.execute(f"CREATE INDEX {prefix}_{build} ON {table} ({columns})")
+
+def save_links_schema(db, links):
+    db.execute("INSERT OR REPLACE INTO cache_state (key, value) VALUES ('links_schema', ?)", (links,))
+
+def save_change_id(db, change_id):
+    if change_id is not None:
+        db.execute(
+            "INSERT OR REPLACE INTO cache_state (key, value) VALUES ('bridge_change_id', ?)",
+            (str(change_id),)
+        )
+
+def save_build_state(db, generation, links, change_id, completed=True):
+    """
+    Records what a build was made with. Unversioned builds go live right away, so this goes
+    straight to cache_state; a generation's is copied there when it is deployed. A generation
+    is claimed with completed=False and only becomes deployable once its build saves it again.
+    """
+    if generation is None:
+        save_change_id(db, change_id)
+        save_links_schema(db, links)
+        return
+    db.execute(
+        "INSERT OR REPLACE INTO cache_generations (generation, built, links_schema, bridge_change_id, completed) VALUES (?, ?, ?, ?, ?)",
+        (generation, time.strftime('%Y-%m-%d %H:%M:%S'), links, change_id, int(completed))
+    )
+
+def list_files(directory, recursive=True):
+    """Yields the files under directory that become subnodes, skipping .git and other hidden directories."""
+    for dirpath, dirnames, filenames in os.walk(directory):
+        dirnames[:] = [d for d in dirnames if not d.startswith('.')] if recursive else []
+        for filename in filenames:
+            if filename.endswith(SUBNODE_SUFFIXES):
+                yield os.path.join(dirpath, filename)
+
+def shards(root):
+    """
+    Splits the Agora into units of work for parallel parsing: one per garden (or stoa, etc.),
+    plus the files sitting directly in root and in its top level directories.
+    Together they cover the same files as list_files(root).
+    """
+    result = [(root, False)]
+    for top in sorted(os.scandir(root), key=lambda e: e.name):
+        if top.name.startswith('.') or not top.is_dir():
+            continue
+        result.append((top.path, False))
+        for entry in sorted(os.scandir(top.path), key=lambda e: e.name):
+            if not entry.name.startswith('.') and entry.is_dir():
+                result.append((entry.path, True))
+    return result
+
+def init_parser(config):
+    """Process pool initializer: each parser process gets its own app, with the parent's config on top."""
+    app = create_app()
+    app.config.update(config)
+    app.app_context().push()
+
+def parse_shard(shard):
+    """
+    Parses every subnode in a shard (see shards()). Runs in a pool process, so it returns
+    plain tuples of (file, file mtime, path, user, node, mtime, forward links).
+    """
+    directory, recursive = shard
+    records = []
+    for file in list_files(directory, recursive):
+        try:
+            subnode = Subnode(file)
+            records.append((file, os.path.getmtime(file), subnode.uri, subnode.user, subnode.wikilink,
+                            subnode.mtime, list(subnode.forward_links)))
+        except Exception as e:
+            print(f"Could not parse {file}: {e}")
+    return records
+
+def populate_parallel(db, app, jobs, links='node', suffix='_new'):
+    """
+    Fills subnodes_new, links_new and subnode_files_new (or the tables with another suffix)
+    by parsing shards in a pool of jobs processes; this process is the only one writing to
+    the database. links is the links schema, see build_cache.
+    """
+    start_time = time.time()
+    config = {'AGORA_PATH': app.config['AGORA_PATH']}
+    pending_shards = iter(shards(app.config['AGORA_PATH']))
+    subnodes_by_node = defaultdict(list)
+    links_by_node = defaultdict(set)
+    subnode_count = 0
+
+    with ProcessPoolExecutor(jobs, initializer=init_parser, initargs=(config,)) as pool:
+        in_flight = set()
+        while True:
+            # Keep at most two shards per process in flight, so parsed results can't pile up
+            # in memory faster than we write them.
+            for shard in pending_shards:
+                in_flight.add(pool.submit(parse_shard, shard))
+                if len(in_flight) >= 2 * jobs:
+                    break
+            if not in_flight:
+                break
+            done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                records = future.result()
+                db.executemany(
+                    f"INSERT INTO subnodes{suffix} (path, user, node, mtime) VALUES (?, ?, ?, ?)",
+                    [(path, user, node, mtime) for _, _, path, user, node, mtime, _ in records]
+                )
+                db.executemany(
+                    f"INSERT OR REPLACE INTO subnode_files{suffix} (file, path, mtime) VALUES (?, ?, ?)",
+                    [(file, path, file_mtime) for file, file_mtime, path, _, _, _, _ in records]
+                )
+                if links == 'subnode':
+                    insert_chunked(
+                        db,
+                        f"INSERT INTO links{suffix} (source_path, source_node, target_node, type) VALUES (?, ?, ?, ?)",
+                        ((path, node, link, 'wikilink')
+                         for _, _, path, _, node, _, forward_links in records
+                         for link in sorted(set(forward_links)))
+                    )
+                else:
+                    for _, _, path, _, node, _, forward_links in records:
+                        subnodes_by_node[node].append(path)
+                        links_by_node[node].update(forward_links)
+                subnode_count += len(records)
+    print(f"Parsed and inserted {subnode_count} subnodes with {jobs} processes in {time.time() - start_time:.2f} seconds.")
+
+    if links == 'subnode':
+        create_cache_indexes(db, suffix, links)
+        return
+
+    # Links can only be written once all of a node's subnodes are known; see update_cache.
+    links_to_insert = (
+        (path, node, link, 'wikilink')
+        for node, paths in subnodes_by_node.items()
+        for link in sorted(links_by_node[node])
+        for path in paths
+    )
+    count = insert_chunked(
+        db,
+        f"REPLACE INTO links{suffix} (source_path, source_node, target_node, type) VALUES (?, ?, ?, ?)",
+        links_to_insert
+    )
+    print(f"Inserted {count} links.")
+    create_cache_indexes(db, suffix, links)
+
+def last_change_id(bridge_db_path):
+    """Returns the id of the newest row in the bridge's garden_changes table, or 0."""
+    with closing(sqlite3.connect(f"file:{bridge_db_path}?mode=ro", uri=True)) as bridge:
+        return bridge.execute("SELECT COALESCE(MAX(id), 0) FROM garden_changes").fetchone()[0]
+
+def build_cache(app, bridge_db_path=None, jobs=1, links='node', versioned=False):
 
     """
 
     Builds the graph cache from the filesystem and stores it in new SQLite tables.
 
+    With links='node' every subnode gets a row for each forward link of its node, as the server
+    has always expected. links='subnode' stores only the links each subnode actually contains,
+    which is a fraction of the rows, and indexes them by target and source node; readers must
+    then aggregate per node themselves (e.g. SELECT DISTINCT target_node ... WHERE source_node = ?).
+
+    With versioned=True the tables are a new generation (subnodes_g<N> etc.) for
+    deploy_generation instead of the _new tables, and the generation number is returned
+    (True otherwise) so that exactly this build gets deployed.
+
     """
 
     print("Starting cache build...")
@@ -57,7 +364,27 @@ def build_cache(app):
     # Ensure the database and base tables are created if they don't exist.
     # We connect directly to the db; this worker is independent of the Flask app.
     with closing(sqlite3.connect(db_path)) as db:
-        create_tables(db)
+        with db:
+            ensure_tables(db)
+            generation = None
+            if versioned:
+                generation = db.execute("SELECT COALESCE(MAX(generation), 0) + 1 FROM cache_generations").fetchone()[0]
+                # Claim the number now so that a concurrent build can't pick it too.
+                save_build_state(db, generation, links, None, completed=False)
+    suffix = f"_g{generation}" if versioned else '_new'
+
+    # Everything the manifest reports from here on will be applied by the next incremental update.
+    change_id = last_change_id(bridge_db_path) if bridge_db_path else None
+
+    if jobs > 1:
+        with closing(sqlite3.connect(db_path)) as db:
+            bulk_load(db)
+            with db:
+                create_new_tables(db, suffix)
+                populate_parallel(db, app, jobs, links, suffix)
+                save_build_state(db, generation, links, change_id)
+        print(f"Cache build complete in {time.time() - start_time:.2f} seconds.")
+        return generation or True
 
     # Build the graph from the filesystem, which requires an app context.
     with app.app_context():
@@ -67,92 +394,442 @@ def build_cache(app):
     print(f"Found {len(all_nodes)} nodes to cache.")
 
     # We will write to temporary tables first to avoid disrupting the live application.
-    subnodes_table = "subnodes_new"
-    links_table = "links_new"
+    subnodes_table = f"subnodes{suffix}"
+    links_table = f"links{suffix}"
 
     with closing(sqlite3.connect(db_path)) as db:
+        bulk_load(db)
         with db:  # This ensures the whole block is a single transaction.
-            print("Creating new temporary tables...")
-            db.execute(f"DROP TABLE IF EXISTS {subnodes_table}")
-            db.execute(f"DROP TABLE IF EXISTS {links_table}")
-            
-            # Schema must match sqlite_engine.py
-            db.execute(f"""
-                CREATE TABLE {subnodes_table} (
-                    path TEXT PRIMARY KEY,
-                    user TEXT NOT NULL,
-                    node TEXT NOT NULL,
-                    mtime INTEGER NOT NULL
-                )
-            """)
-            db.execute(f"""
-                CREATE TABLE {links_table} (
-                    source_path TEXT NOT NULL,
-                    target_node TEXT NOT NULL,
-                    type TEXT NOT NULL,
-                    source_node TEXT,
-                    PRIMARY KEY (source_path, target_node, type)
-                )
-            """)
+            create_new_tables(db, suffix)
 
             print(f"Populating {subnodes_table}...")
-            subnodes_to_insert = []
-            for node in all_nodes:
-                for subnode in node.subnodes:
-                    subnodes_to_insert.append((
-                        subnode.uri,
-                        subnode.user,
-                        node.uri,
-                        subnode.mtime
-                    ))
-            db.executemany(
+            subnodes_to_insert = (
+                (subnode.uri, subnode.user, node.uri, subnode.mtime)
+                for node in all_nodes
+                for subnode in node.subnodes
+            )
+            count = insert_chunked(
+                db,
                 f"INSERT INTO {subnodes_table} (path, user, node, mtime) VALUES (?, ?, ?, ?)",
                 subnodes_to_insert
             )
-            print(f"Inserted {len(subnodes_to_insert)} subnodes.")
+            print(f"Inserted {count} subnodes.")
+
+            insert_chunked(
+                db,
+                f"INSERT OR REPLACE INTO subnode_files{suffix} (file, path, mtime) VALUES (?, ?, ?)",
+                ((subnode.path, subnode.uri, os.path.getmtime(subnode.path))
+                 for node in all_nodes for subnode in node.subnodes if os.path.exists(subnode.path))
+            )
+
+            save_build_state(db, generation, links, change_id)
 
             print(f"Populating {links_table}...")
-            links_to_insert = []
-            for node in all_nodes:
-                # Using .forward_links() as it's the most direct representation of [[links]] in files.
-                for link in node.forward_links():
-                    # We need to add one entry for each subnode in the source node.
-                    for subnode in node.subnodes:
-                        links_to_insert.append((subnode.uri, node.uri, link, 'wikilink'))
+            if links == 'subnode':
+                count = insert_chunked(
+                    db,
+                    f"INSERT INTO {links_table} (source_path, source_node, target_node, type) VALUES (?, ?, ?, ?)",
+                    ((subnode.uri, node.uri, link, 'wikilink')
+                     for node in all_nodes
+                     for subnode in node.subnodes
+                     for link in sorted(set(subnode.forward_links)))
+                )
+                create_cache_indexes(db, suffix, links)
+                print(f"Inserted {count} links.")
+                print(f"Cache build complete in {time.time() - start_time:.2f} seconds.")
+                return generation or True
+
+            # Using .forward_links() as it's the most direct representation of [[links]] in files.
+            # We need to add one entry for each subnode in the source node. This is generated
+            # lazily: it's the product of links and subnodes per node, and can get large.
+            links_to_insert = (
+                (subnode.uri, node.uri, link, 'wikilink')
+                for node in all_nodes
+                for link in node.forward_links()
+                for subnode in node.subnodes
+            )
             
             # Using REPLACE to handle any potential duplicates gracefully, though there shouldn't be.
-            db.executemany(
+            count = insert_chunked(
+                db,
                 f"REPLACE INTO {links_table} (source_path, source_node, target_node, type) VALUES (?, ?, ?, ?)",
                 links_to_insert
             )
-            print(f"Inserted {len(links_to_insert)} links.")
+            print(f"Inserted {count} links.")
+            create_cache_indexes(db, suffix, links)
 
     print(f"Cache build complete in {time.time() - start_time:.2f} seconds.")
-    return True
+    return generation or True
 
-def deploy_cache(app):
+def deploy_cache(app, versioned=False, generation=None):
     """
     Atomically swaps the newly built cache tables into place.
+    With versioned=True, deploys generation (as returned by build_cache) instead, or the newest
+    completed one if not given; see deploy_generation.
     """
     print("Deploying cache...")
     db_path = get_db_path(app)
+    if versioned:
+        with closing(sqlite3.connect(db_path)) as db:
+            if generation is None:
+                generation = db.execute("SELECT MAX(generation) FROM cache_generations WHERE completed").fetchone()[0]
+                if generation is None:
+                    raise ValueError("There is no completed generation to deploy.")
+            analyze_tables(db, f"_g{generation}")
+            deploy_generation(db, generation)
+        return
+
     subnodes_table = "subnodes"
     links_table = "links"
     subnodes_new_table = "subnodes_new"
     links_new_table = "links_new"
 
     with closing(sqlite3.connect(db_path)) as db:
+        # Coming back from versioned deploys, the live names are views.
+        views = is_view(db, subnodes_table)
         with db: # Transaction
             print("Swapping tables...")
-            db.execute(f"DROP TABLE IF EXISTS {subnodes_table}")
-            db.execute(f"ALTER TABLE {subnodes_new_table} RENAME TO {subnodes_table}")
-            db.execute(f"DROP TABLE IF EXISTS {links_table}")
-            db.execute(f"ALTER TABLE {links_new_table} RENAME TO {links_table}")
+            for table, new_table in ((subnodes_table, subnodes_new_table), (links_table, links_new_table),
+                                     ("subnode_files", "subnode_files_new")):
+                db.execute(f"DROP {'VIEW' if views else 'TABLE'} IF EXISTS {table}")
+                db.execute(f"ALTER TABLE {new_table} RENAME TO {table}")
+        if views:
+            drop_generations(db, keep=())
+        analyze_tables(db)
     print("Cache deployed.")
 
+def analyze_tables(db, suffix=''):
+    """
+    Refreshes sqlite_stat1 for the cache tables. Besides the query planner, the API's status page
+    reads its row counts from there instead of counting millions of rows. Statistics don't follow
+    renames, so this runs on the deployed names.
+    """
+    with db:
+        for table in CACHE_TABLES:
+            db.execute(f"ANALYZE {table}{suffix}")
+
+def drop_generations(db, keep):
+    """
+    Drops the tables of every generation not in keep. They're no longer read, so this doesn't block anyone.
+    Generations still being built by a concurrent run are left alone, unless they were claimed over a
+    day ago and so were left behind by a build that died.
+    """
+    stale = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(time.time() - 86400))
+    generations = [g for (g,) in db.execute(
+        "SELECT generation FROM cache_generations WHERE completed OR built < ?", (stale,)
+    ) if g not in keep]
+    for generation in generations:
+        with db:
+            for table in CACHE_TABLES:
+                db.execute(f"DROP TABLE IF EXISTS {table}_g{generation}")
+            db.execute("DELETE FROM cache_generations WHERE generation = ?", (generation,))
+    if generations:
+        print(f"Dropped generations {', '.join(map(str, generations))}.")
+
+def deploy_generation(db, generation):
+    """
+    Points the subnodes, links and subnode_files views at a generation's tables. That's all the
+    transaction does, so it takes milliseconds however big the cache is, and (in WAL mode)
+    readers never wait for it. The generation deployed before stays around for rollback_cache;
+    older ones are dropped afterwards.
+    """
+    current = get_state(db, 'generation')
+    current = int(current) if current and is_view(db, 'subnodes') else None
+    row = db.execute(
+        "SELECT links_schema, bridge_change_id, completed FROM cache_generations WHERE generation = ?", (generation,)
+    ).fetchone()
+    if row is None:
+        raise ValueError(f"Generation {generation} doesn't exist.")
+    links, change_id, completed = row
+    if not completed:
+        raise ValueError(f"Generation {generation} is still being built.")
+    if generation == current:
+        print(f"Generation {generation} is already live.")
+        return
+
+    with db:
+        print(f"Switching to generation {generation}...")
+        if current is not None:
+            # Incremental updates may have moved the live generation on since it was built.
+            db.execute("""
+                UPDATE cache_generations SET
+                    links_schema = (SELECT value FROM cache_state WHERE key = 'links_schema'),
+                    bridge_change_id = (SELECT value FROM cache_state WHERE key = 'bridge_change_id')
+                WHERE generation = ?
+            """, (current,))
+        for table in CACHE_TABLES:
+            if is_view(db, table):
+                db.execute(f"DROP VIEW {table}")
+            else:
+                # The first versioned deploy replaces the plain tables. Dropping them can take a
+                # while, but only this once.
+                db.execute(f"DROP TABLE IF EXISTS {table}")
+            db.execute(f"CREATE VIEW {table} AS SELECT * FROM {table}_g{generation}")
+        db.execute("INSERT OR REPLACE INTO cache_state (key, value) VALUES ('generation', ?)", (str(generation),))
+        db.execute("INSERT OR REPLACE INTO cache_state (key, value) VALUES ('previous_generation', ?)",
+                   (str(current) if current is not None else None,))
+        save_links_schema(db, links)
+        db.execute("DELETE FROM cache_state WHERE key = 'bridge_change_id'")
+        save_change_id(db, change_id)
+
+    drop_generations(db, keep=(generation, current))
+    print(f"Generation {generation} deployed.")
+
+def rollback_cache(app):
+    """Switches back to the generation that was live before the last versioned deploy."""
+    with closing(sqlite3.connect(get_db_path(app))) as db:
+        create_state_tables(db)
+        previous = get_state(db, 'previous_generation')
+        if not is_view(db, 'subnodes') or previous is None:
+            print("There is no previous generation to roll back to.")
+            return False
+        deploy_generation(db, int(previous))
+    return True
+
+def scan_changes(root, known):
+    """
+    Walks the Agora and compares file mtimes against the ones recorded at the last update.
+    Returns (changed, deleted) sets of absolute file paths.
+    """
+    seen = set()
+    changed = set()
+    for file in list_files(root):
+        try:
+            mtime = os.path.getmtime(file)
+        except OSError:
+            continue
+        seen.add(file)
+        if known.get(file) != mtime:
+            changed.add(file)
+    return changed, set(known) - seen
+
+def manifest_changes(root, bridge_db_path, since):
+    """
+    Reads the files pull.py reported as changed after change id since from bridge.db.
+    Returns (changed, deleted, last_id).
+    """
+    changed = set()
+    deleted = set()
+    last_id = since
+    with closing(sqlite3.connect(f"file:{bridge_db_path}?mode=ro", uri=True)) as bridge:
+        rows = bridge.execute(
+            "SELECT id, target, status, path FROM garden_changes WHERE id > ? ORDER BY id", (since,)
+        )
+        for change_id, target, status, path in rows:
+            last_id = change_id
+            if not path.endswith(SUBNODE_SUFFIXES):
+                continue
+            # Like list_files, skip hidden directories (e.g. .trash/ or .foam/templates/).
+            if any(part.startswith('.') for part in path.split('/')[:-1]):
+                continue
+            file = os.path.join(root, target, path)
+            # Later rows win, and a file may be gone again by now whatever the manifest says.
+            if status != 'D' and os.path.exists(file):
+                changed.add(file)
+                deleted.discard(file)
+            else:
+                deleted.add(file)
+                changed.discard(file)
+    return changed, deleted, last_id
+
+def node_links(subnodes):
+    """The union of the forward links of a node's subnodes, like Node.forward_links()."""
+    links = set()
+    for subnode in subnodes:
+        links.update(subnode.forward_links)
+    return sorted(links)
+
+def update_cache(app, bridge_db_path=None, links='node'):
+    """
+    Applies filesystem changes since the last build or update to the live tables in place.
+    Changes come from the bridge's garden_changes manifest if bridge_db_path is given,
+    otherwise from comparing file mtimes. Returns False if a full build is needed instead,
+    including when the cache was built with a different links schema (see build_cache).
+    """
+    print("Starting incremental update...")
+    start_time = time.time()
+    db_path = get_db_path(app)
+    root = app.config['AGORA_PATH']
+
+    with closing(sqlite3.connect(db_path)) as db:
+        with db:
+            ensure_tables(db)
+        # With versioned deploys we write to the live generation's tables, not through its views.
+        suffix = live_suffix(db)
+        known = dict(db.execute(f"SELECT file, mtime FROM subnode_files{suffix}"))
+        row = db.execute("SELECT value FROM cache_state WHERE key = 'bridge_change_id'").fetchone()
+        schema = db.execute("SELECT value FROM cache_state WHERE key = 'links_schema'").fetchone()
+    if not known:
+        print("No file index yet (the cache predates incremental updates).")
+        return False
+    if (schema[0] if schema else 'node') != links:
+        print(f"The cache was built with a different links schema than {links}.")
+        return False
+
+    last_id = None
+    if bridge_db_path:
+        if row is None:
+            print("No manifest position recorded yet.")
+            return False
+        changed, deleted, last_id = manifest_changes(root, bridge_db_path, int(row[0]))
+        deleted &= set(known)
+    else:
+        changed, deleted = scan_changes(root, known)
+    print(f"Found {len(changed)} changed and {len(deleted)} deleted files in {time.time() - start_time:.2f} seconds.")
+
+    with closing(sqlite3.connect(db_path)) as db:
+        with db, app.app_context():
+            # Caches built before these indexes existed get them once, here.
+            create_cache_indexes(db, suffix, links)
+            # With the node links schema every subnode carries its node's links, so any node
+            # that gains, loses or changes a subnode gets all of its links rewritten.
+            affected_nodes = set()
+            for file in changed | deleted:
+                existing = db.execute(
+                    f"SELECT s.path, s.node FROM subnode_files{suffix} f JOIN subnodes{suffix} s ON s.path = f.path WHERE f.file = ?",
+                    (file,)
+                ).fetchone()
+                if existing:
+                    path, node = existing
+                    affected_nodes.add(node)
+                    db.execute(f"DELETE FROM subnodes{suffix} WHERE path = ?", (path,))
+                    db.execute(f"DELETE FROM links{suffix} WHERE source_path = ?", (path,))
+                db.execute(f"DELETE FROM subnode_files{suffix} WHERE file = ?", (file,))
+
+            parsed = {}
+            links_written = 0
+            for file in changed:
+                try:
+                    subnode = Subnode(file)
+                    # A pull may delete the file under us; its old rows are gone already.
+                    mtime = os.path.getmtime(file)
+                except Exception as e:
+                    print(f"Could not parse {file}: {e}")
+                    continue
+                parsed[file] = subnode
+                db.execute(
+                    f"INSERT OR REPLACE INTO subnodes{suffix} (path, user, node, mtime) VALUES (?, ?, ?, ?)",
+                    (subnode.uri, subnode.user, subnode.wikilink, subnode.mtime)
+                )
+                db.execute(
+                    f"INSERT OR REPLACE INTO subnode_files{suffix} (file, path, mtime) VALUES (?, ?, ?)",
+                    (file, subnode.uri, mtime)
+                )
+                if links == 'subnode':
+                    rows = [(subnode.uri, subnode.wikilink, link, 'wikilink') for link in sorted(set(subnode.forward_links))]
+                    db.executemany(
+                        f"INSERT OR REPLACE INTO links{suffix} (source_path, source_node, target_node, type) VALUES (?, ?, ?, ?)",
+                        rows
+                    )
+                    links_written += len(rows)
+                else:
+                    affected_nodes.add(subnode.wikilink)
+
+            if links == 'subnode':
+                affected_nodes = set()
+            for node in affected_nodes:
+                files = [f for (f,) in db.execute(
+                    f"SELECT f.file FROM subnode_files{suffix} f JOIN subnodes{suffix} s ON s.path = f.path WHERE s.node = ?", (node,)
+                )]
+                subnodes = []
+                for file in files:
+                    if file not in parsed:
+                        try:
+                            parsed[file] = Subnode(file)
+                        except Exception as e:
+                            print(f"Could not parse {file}: {e}")
+                            continue
+                    subnodes.append(parsed[file])
+                forward_links = node_links(subnodes)
+                db.execute(f"DELETE FROM links{suffix} WHERE source_node = ?", (node,))
+                rows = [(subnode.uri, node, link, 'wikilink') for link in forward_links for subnode in subnodes]
+                db.executemany(
+                    f"REPLACE INTO links{suffix} (source_path, source_node, target_node, type) VALUES (?, ?, ?, ?)",
+                    rows
+                )
+                links_written += len(rows)
+
+            save_change_id(db, last_id)
+    print(f"Updated {len(parsed)} subnodes and {links_written} links across {len(affected_nodes)} nodes.")
+    print(f"Incremental update complete in {time.time() - start_time:.2f} seconds.")
+    return True
+
+def refresh(app, bridge_db_path, jobs, links, versioned):
+    """Brings the cache up to date: incrementally if possible, with a full build and deploy otherwise."""
+    if update_cache(app, bridge_db_path, links=links):
+        return
+    generation = build_cache(app, bridge_db_path, jobs=jobs, links=links, versioned=versioned)
+    if generation:
+        deploy_cache(app, versioned=versioned, generation=generation if versioned else None)
+
+def run_daemon(app, bridge_db_path, jobs, links, versioned, poll_interval, debounce, max_delay, scan_interval):
+    """
+    Keeps the cache fresh from a single long-running process, so the app is created (and
+    agora-server imported) once. Every poll_interval seconds it checks the bridge's change
+    manifest; once new changes have been quiet for debounce seconds (or have been waiting for
+    max_delay), they're applied incrementally. Every scan_interval seconds, if set, files are
+    also compared by mtime to pick up sources the manifest doesn't cover (e.g. stoas).
+    """
+    # Under systemd stdout is a pipe; flush progress lines as they happen.
+    sys.stdout.reconfigure(line_buffering=True)
+    print(f"Cache builder daemon started (manifest: {bridge_db_path or 'none'}).")
+    refresh(app, bridge_db_path, jobs, links, versioned)
+    applied = last_change_id(bridge_db_path) if bridge_db_path else None
+    last_scan = time.time()
+
+    while True:
+        time.sleep(poll_interval)
+        try:
+            if bridge_db_path:
+                latest = last_change_id(bridge_db_path)
+                if latest > applied:
+                    # A busy pull cycle reports many gardens in a row; wait for it to settle so
+                    # they're applied in one update.
+                    first_seen = time.time()
+                    while time.time() - first_seen < max_delay:
+                        time.sleep(debounce)
+                        newer = last_change_id(bridge_db_path)
+                        if newer == latest:
+                            break
+                        latest = newer
+                    refresh(app, bridge_db_path, jobs, links, versioned)
+                    applied = latest
+            if scan_interval and time.time() - last_scan >= scan_interval:
+                refresh(app, None, jobs, links, versioned)
+                last_scan = time.time()
+        except Exception as e:
+            # E.g. the database is locked by a long write, or a pull removed files or gardens
+            # while we were reading them; try again on the next poll.
+            print(f"Update failed: {e!r}")
+
+parser = argparse.ArgumentParser(description='Builds the Agora\'s SQLite cache of subnodes and links from the filesystem.')
+parser.add_argument('--incremental', action='store_true', help='Only update subnodes whose files changed since the last run, in place. Falls back to a full build when there is no previous run to compare against.')
+parser.add_argument('--jobs', type=int, default=os.cpu_count(), help='Processes that parse gardens in parallel during a full build (default: one per CPU). 1 builds the Graph in this process instead.')
+parser.add_argument('--links', choices=['node', 'subnode'], default='node', help='Links schema: "node" repeats each forward link of a node for all of its subnodes (what the server expects today), "subnode" stores only the links each subnode contains, indexed by target_node and source_node.')
+parser.add_argument('--versioned', action='store_true', help='Build into a new generation of tables and deploy it by repointing the subnodes/links views, so readers never wait for a deploy. The previous generation is kept for --rollback. Requires an agora-server that does not run sqlite_engine.create_tables() on these names, since SQLite can\'t index views.')
+parser.add_argument('--rollback', action='store_true', help='Switch back to the generation that was live before the last --versioned deploy, and exit.')
+parser.add_argument('--daemon', action='store_true', help='Keep running and apply changes incrementally as they come in, see --poll-interval and --scan-interval.')
+parser.add_argument('--poll-interval', dest='poll_interval', type=float, default=5, help='With --daemon and --changes, how often to check the manifest for changes, in seconds.')
+parser.add_argument('--debounce', type=float, default=10, help='With --daemon, wait until the manifest has had no new changes for this many seconds before applying them.')
+parser.add_argument('--max-delay', dest='max_delay', type=float, default=120, help='With --daemon, apply changes after this many seconds even if more keep coming.')
+parser.add_argument('--scan-interval', dest='scan_interval', type=float, default=600, help='With --daemon, also compare file mtimes this often, in seconds (0 disables); this is the only way changes are found without --changes.')
+parser.add_argument('--changes', metavar='BRIDGE_DB', help='With --incremental, take changed files from the garden_changes manifest in this bridge.db (e.g. ~/agora/bridge.db) instead of comparing mtimes.')
+
 if __name__ == "__main__":
+    args = parser.parse_args()
+    bridge_db_path = os.path.expanduser(args.changes) if args.changes else None
     app = create_app()
     main_start_time = time.time()
-    if build_cache(app):
-        deploy_cache(app)
+    if args.rollback:
+        rollback_cache(app)
+    elif args.daemon:
+        try:
+            run_daemon(app, bridge_db_path, args.jobs, args.links, args.versioned,
+                       args.poll_interval, args.debounce, args.max_delay, args.scan_interval)
+        except KeyboardInterrupt:
+            print("Cache builder daemon stopped.")
+    elif not (args.incremental and update_cache(app, bridge_db_path, links=args.links)):
+        generation = build_cache(app, bridge_db_path, jobs=args.jobs, links=args.links, versioned=args.versioned)
+        if generation:
+            deploy_cache(app, versioned=args.versioned, generation=generation if args.versioned else None)
     print(f"Worker finished in {time.time() - main_start_time:.2f} seconds.")
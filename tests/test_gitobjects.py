@@ -0,0 +1,70 @@
+"""
+Checks api/gitobjects.py against git itself. Run with: python -m unittest discover tests
+"""
+import importlib.util
+import os
+import shutil
+import subprocess
+import tempfile
+import unittest
+
+# Loaded by path so the test doesn't need the Flask app that importing the api package sets up.
+spec = importlib.util.spec_from_file_location(
+    'gitobjects', os.path.join(os.path.dirname(__file__), '..', 'api', 'gitobjects.py'))
+gitobjects = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(gitobjects)
+
+
+@unittest.skipUnless(shutil.which('git'), "git is not installed")
+class LastCommitDateTest(unittest.TestCase):
+
+    def setUp(self):
+        self.repo = tempfile.mkdtemp(prefix='gitobjects-')
+        self.addCleanup(shutil.rmtree, self.repo)
+        self.git('init', '-q')
+        # Similar commits of a growing file, so that packing them produces deltas.
+        for i in range(30):
+            with open(os.path.join(self.repo, 'note.md'), 'w') as f:
+                f.write(''.join(f"line {n} of a note about [[gardens]]\n" for n in range(i * 10)))
+            self.git('add', 'note.md')
+            self.git('commit', '-q', '-m', f"Edit {i}", date=f"2024-0{i % 9 + 1}-1{i % 10} 1{i % 10}:30:00 +0530")
+        self.git('commit', '-q', '--allow-empty', '-m', 'Last', date="2024-03-01 23:45:12 -0800")
+
+    def git(self, *args, date=None):
+        env = dict(os.environ, GIT_AUTHOR_NAME='Test', GIT_AUTHOR_EMAIL='test@example.org',
+                   GIT_COMMITTER_NAME='Test', GIT_COMMITTER_EMAIL='test@example.org')
+        if date:
+            env['GIT_AUTHOR_DATE'] = env['GIT_COMMITTER_DATE'] = date
+        return subprocess.run(['git', '-C', self.repo, *args], env=env, check=True,
+                              capture_output=True, text=True).stdout.strip()
+
+    def expected(self):
+        return self.git('log', '-1', '--format=%cd', '--date=iso')
+
+    def test_loose_objects(self):
+        self.assertEqual(gitobjects.last_commit_date(self.repo), self.expected())
+        self.assertEqual(self.expected(), "2024-03-01 23:45:12 -0800")
+
+    def test_packed_objects_and_refs(self):
+        self.git('gc', '-q', '--aggressive')
+        self.git('pack-refs', '--all')
+        self.assertFalse(os.path.exists(os.path.join(self.repo, '.git', 'objects', self.git('rev-parse', 'HEAD')[:2])))
+        self.assertEqual(gitobjects.last_commit_date(self.repo), self.expected())
+
+    def test_packed_deltas(self):
+        self.git('gc', '-q', '--aggressive')
+        git_dir = os.path.join(self.repo, '.git')
+        # Every object in the pack, deltified ones included, must read back as git has it.
+        for line in self.git('rev-list', '--objects', '--all').splitlines():
+            sha = line.split()[0]
+            kind, data = gitobjects.read_object(git_dir, sha)
+            expected = subprocess.run(['git', '-C', self.repo, 'cat-file', kind.decode(), sha],
+                                      check=True, capture_output=True).stdout
+            self.assertEqual(data, expected, sha)
+
+    def test_not_a_repository(self):
+        self.assertIsNone(gitobjects.last_commit_date(tempfile.gettempdir()))
+
+
+if __name__ == '__main__':
+    unittest.main()